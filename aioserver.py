@@ -0,0 +1,363 @@
+'''
+Webserver engine built on asyncio streams, for running Things on CPython gateways and simulators.
+
+It runs on CPython 3.7 or later only, and needs the host environment of the library (see
+``host/zenv.py``) to be imported first, as webthing relies on the Zerynth builtins and device
+modules. Routes are shared with :mod:`webserver`: the registration functions below are the ones of
+webserver, and handlers follow the same contract. Every connection is served by a coroutine,
+so that thousands of keep-alive connections cost no thread. Handlers run in a pool of
+threads, since getters and setters may block; handlers that are coroutine functions run on
+the event loop instead.
+'''
+
+import asyncio
+import inspect
+import json
+import threading
+import time
+from mozilla.webthing import cbor
+from mozilla.webthing import webserver
+from mozilla.webthing import websocket
+
+from concurrent.futures import ThreadPoolExecutor
+
+# the route table is the one of webserver
+register_handler = webserver.register_handler
+register_handlers = webserver.register_handlers
+remove_handler = webserver.remove_handler
+register_dispatcher = webserver.register_dispatcher
+register_dispatchers = webserver.register_dispatchers
+remove_dispatcher = webserver.remove_dispatcher
+enable_metrics = webserver.enable_metrics
+
+# address to listen on; with PORT 0 a free port is chosen, and found in bound_port once listening
+HOST = "0.0.0.0"
+PORT = 80
+bound_port = None
+
+# Connections beyond MAX_CONNECTIONS open at the same time are answered with 503 Service
+# Unavailable. A request line or header line longer than MAX_LINE is refused; the other limits
+# and timeouts are the ones of webserver.
+MAX_CONNECTIONS = 10000
+MAX_LINE = 8192
+
+# default number of threads running handlers, when start() is given no workers
+DEFAULT_WORKERS = 16
+
+_loop = None
+_loop_thread = None
+_executor = None
+_connections = 0
+# set once start() listens, or has failed to
+_listening = threading.Event()
+
+
+def start(workers=0, queue_size=4):
+    # Accept connections and serve them; never returns.
+
+    # * *workers* is the number of threads running handlers, DEFAULT_WORKERS when 0.
+    # * *queue_size* is the number of connections the operating system may keep waiting
+    #     to be accepted (at least 128), as connections are accepted as soon as they arrive.
+    global _loop, _loop_thread, _executor
+    if workers <= 0:
+        workers = DEFAULT_WORKERS
+    _executor = ThreadPoolExecutor(workers)
+    _loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_loop)
+    _loop_thread = threading.get_ident()
+    try:
+        _loop.run_until_complete(_listen(max(queue_size, 128)))
+    finally:
+        _listening.set()
+    _loop.run_forever()
+
+
+def wait_listening():
+    # Wait for start(), running in another thread, to listen, and return bound_port: None if
+    # it failed to.
+    _listening.wait()
+    return bound_port
+
+
+async def _listen(backlog):
+    global bound_port
+    server = await asyncio.start_server(_serve_connection, HOST, PORT, limit=MAX_LINE, backlog=backlog)
+    bound_port = server.sockets[0].getsockname()[1]
+
+
+def resolve(value):
+    # Return value, or what it evaluates to when it is awaitable: a getter, setter or action
+    # callback that is a coroutine function is run on the event loop, while the calling thread
+    # waits for it. Must not be called from the event loop itself.
+    if not inspect.isawaitable(value):
+        return value
+    if _loop is None or threading.get_ident() == _loop_thread:
+        raise RuntimeError("awaitable result outside of a handler thread")
+    return asyncio.run_coroutine_threadsafe(_await(value), _loop).result()
+
+
+async def _await(value):
+    return await value
+
+
+def _now():
+    # milliseconds, as timers.now() on the device
+    return int(time.monotonic() * 1000)
+
+
+async def _serve_connection(reader, writer):
+    # Serve every request sent on a connection, as webserver._serve_connection() does.
+    global _connections
+    if _connections >= MAX_CONNECTIONS:
+        page = webserver._encode(webserver._html_page(503, "Service Unavailable"))
+        writer.write(webserver._encode(
+            "HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Type: text/html\r\n"
+            "Content-Length: %d\r\nConnection: close\r\n\r\n" % (webserver.RETRY_AFTER, len(page))
+        ) + page)
+        await _close(writer)
+        return
+    _connections += 1
+    detached = False
+    try:
+        served = 0
+        while served < webserver.MAX_KEEPALIVE_REQUESTS:
+            try:
+                line = await asyncio.wait_for(reader.readline(), webserver.KEEPALIVE_TIMEOUT / 1000)
+            except (asyncio.TimeoutError, ConnectionError):
+                break
+            except ValueError:
+                writer.write(webserver._ERROR_PAGES[414][0])
+                break
+            if not line:
+                break
+            started = _now()
+            # bytes of the request received so far, counted by _parse_request()
+            received = [len(line)]
+            try:
+                request = await asyncio.wait_for(_parse_request(reader, line, received),
+                                                 webserver.READ_TIMEOUT / 1000)
+            except webserver._HttpError as e:
+                writer.write(webserver._ERROR_PAGES[e.code][0])
+                _record("unmatched", "other", e.code, _now() - started, 0, 0, received[0],
+                        len(webserver._ERROR_PAGES[e.code][0]))
+                break
+            except asyncio.TimeoutError:
+                writer.write(webserver._ERROR_PAGES[408][0])
+                break
+            if request is None:
+                continue
+            parsed = _now()
+            method, path, version, headers, payload = request
+            served += 1
+            keep_alive = webserver._keep_alive(version, headers) and served < webserver.MAX_KEEPALIVE_REQUESTS
+            if headers.get("upgrade", "").lower() == "websocket" and _upgrade(reader, writer, path, headers):
+                # the connection now belongs to the WebSocket handler thread
+                detached = True
+                break
+            route, method, code, handler_ms, response = await _handle_request(
+                method, path, headers, payload, keep_alive, webserver._prefers_cbor(headers))
+            writer.write(response)
+            await asyncio.wait_for(writer.drain(), webserver.WRITE_TIMEOUT / 1000)
+            _record(route, method, code, parsed - started, handler_ms, _now() - parsed - handler_ms,
+                    received[0], len(response))
+            if not keep_alive:
+                break
+    except Exception:
+        # the client went away or was too slow reading the response
+        pass
+    finally:
+        _connections -= 1
+        if not detached:
+            await _close(writer)
+
+
+async def _close(writer):
+    try:
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+    except Exception:
+        pass
+
+
+def _record(route, method, code, parse_ms, handler_ms, write_ms, bytes_in, bytes_out):
+    if webserver._metrics is not None:
+        webserver._metrics.record(route, method, code, parse_ms, handler_ms, write_ms, bytes_in, bytes_out)
+
+
+async def _parse_request(reader, line, received):
+    # Parse the request starting with line, as webserver._parse_request() does, and return
+    # a tuple (method, path, version, headers, payload), or None for an empty line. The bytes
+    # read after line are added to received[0].
+    line = webserver._decode_line(line.rstrip(b"\r\n"))
+    if not line:
+        # tolerate an empty line between pipelined requests
+        return None
+    method, path, version, query = webserver._parse_request_line(line)
+    data_length = 0
+    headers = {}
+    count = 0
+    while True:
+        try:
+            line = await reader.readline()
+        except ValueError:
+            raise webserver._HttpError(431, "Request Header Fields Too Large")
+        received[0] += len(line)
+        if not line.endswith(b"\n"):
+            # connection dropped in the middle of the headers
+            raise webserver._HttpError(400, "Bad Request")
+        line = webserver._decode_line(line.rstrip(b"\r\n"))
+        if not line:
+            break
+        count += 1
+        data_length = webserver._parse_header(line, count, headers, data_length)
+
+    payload = query
+    if data_length:
+        try:
+            data = await reader.readexactly(data_length)
+        except asyncio.IncompleteReadError as e:
+            received[0] += len(e.partial)
+            raise webserver._HttpError(400, "Bad Request")
+        received[0] += data_length
+        payload = webserver._decode_payload(method, headers, data, query)
+
+    return (method, path, version, headers, payload)
+
+
+async def _handle_request(method, path, headers, payload, keep_alive, use_cbor):
+    # Serve a parsed request and return a tuple (route, method, code, handler time, response bytes).
+    handlers, values = webserver._match(path)
+    if handlers is None:
+        return ("unmatched", "other", 404, 0, _error(404, keep_alive))
+    if method not in handlers:
+        route = "unmatched"
+        for other in handlers:
+            route = handlers[other][2]
+            break
+        return (route, "other", 405, 0, _error(405, keep_alive))
+    fun, static_args, route = handlers[method]
+    if values:
+        static_args = static_args + values
+    started = _now()
+    try:
+        if inspect.iscoroutinefunction(fun):
+            result = await fun(static_args, payload)
+        else:
+            result = await _loop.run_in_executor(_executor, fun, static_args, payload)
+            if inspect.isawaitable(result):
+                result = await result
+        handler_ms = _now() - started
+        if type(result) == tuple:
+            code, message, body = result
+            if body is None:
+                response = _page(code, message, keep_alive)
+            else:
+                response = _data(code, message, body, keep_alive, use_cbor)
+        elif isinstance(result, webserver.Serialized):
+            code, response = _serialized(result, headers, keep_alive)
+        else:
+            code = 200
+            response = _data(200, "Ok", result, keep_alive, use_cbor)
+    except NameError:
+        return (route, method, 400, _now() - started, _error(400, keep_alive))
+    except Exception as e:
+        print("Error executing callback")
+        print(e)
+        return (route, method, 500, _now() - started, _error(500, keep_alive))
+    return (route, method, code, handler_ms, response)
+
+
+def _error(code, keep_alive):
+    if keep_alive:
+        return webserver._ERROR_PAGES[code][1]
+    return webserver._ERROR_PAGES[code][0]
+
+
+def _page(code, message, keep_alive):
+    if code in webserver._ERROR_PAGES:
+        return _error(code, keep_alive)
+    return _response(code, message, "text/html", webserver._encode(webserver._html_page(code, message)), keep_alive)
+
+
+def _data(code, message, data, keep_alive, use_cbor):
+    if use_cbor:
+        return _response(code, message, "application/cbor", cbor.dumps(data), keep_alive)
+    return _response(code, message, "text/json", webserver._encode(json.dumps(data)), keep_alive)
+
+
+def _serialized(result, headers, keep_alive):
+    if result.etag is not None and "if-none-match" in headers:
+        for tag in headers["if-none-match"].split(","):
+            tag = tag.strip()
+            if tag == result.etag or tag == "*":
+                return (304, webserver._encode(webserver._head(304, "Not Modified", None, None, keep_alive, result.etag)))
+    return (200, _response(200, "Ok", result.content_type, result.body, keep_alive, result.etag))
+
+
+def _response(code, message, content_type, body, keep_alive, etag=None):
+    return webserver._encode(webserver._head(code, message, content_type, len(body), keep_alive, etag)) + body
+
+
+def _upgrade(reader, writer, path, headers):
+    # Complete the WebSocket handshake if a "websocket" handler is registered for path and
+    # start it in a new thread, with a blocking view of the connection. Return False if the
+    # request has to be served as usual.
+    global _connections
+    handlers, values = webserver._match(path)
+    if handlers is None or "websocket" not in handlers or "sec-websocket-key" not in headers:
+        return False
+    fun, static_args, route = handlers["websocket"]
+    if values:
+        static_args = static_args + values
+    writer.write(webserver._encode(
+        "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        "Sec-WebSocket-Accept: %s\r\n\r\n" % websocket.accept_key(headers["sec-websocket-key"])
+    ))
+    # counted until the handler returns
+    _connections += 1
+    ws = websocket.WebSocket(_StreamClient(reader, writer))
+    threading.Thread(target=_run_websocket, args=(fun, static_args, ws), daemon=True).start()
+    return True
+
+
+def _run_websocket(fun, static_args, ws):
+    try:
+        fun(static_args, ws)
+    except Exception as e:
+        print("Error executing websocket handler")
+        print(e)
+    ws.close()
+    ws.client.close()
+    _loop.call_soon_threadsafe(_release)
+
+
+def _release():
+    global _connections
+    _connections -= 1
+
+
+class _StreamClient():
+    # Blocking read() and write() over the streams of a connection, for the WebSocket handlers
+    # running in their own thread. A read waiting more than WEBSOCKET_PING_INTERVAL, or a write
+    # more than WEBSOCKET_WRITE_TIMEOUT, raises like a socket timeout does.
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def read(self, n):
+        return asyncio.run_coroutine_threadsafe(self._read(n), _loop).result()
+
+    async def _read(self, n):
+        return await asyncio.wait_for(self.reader.read(n), webserver.WEBSOCKET_PING_INTERVAL / 1000)
+
+    def write(self, data):
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), _loop).result()
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), webserver.WEBSOCKET_WRITE_TIMEOUT / 1000)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(_close(self.writer), _loop).result()
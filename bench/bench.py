@@ -0,0 +1,355 @@
+'''
+Host benchmark of the webserver and of the Thing handlers.
+
+The library runs on CPython through the stand-ins installed by :mod:`zenv`; a load generator
+in the same process opens keep-alive connections on the loopback interface and reports, for
+every operation and number of concurrent clients, requests per second, median and 99th
+percentile latency, and the peak of memory allocated by the interpreter (server and clients
+together) as measured by tracemalloc in a separate, shorter pass.
+
+    python bench/bench.py
+    python bench/bench.py --things 1,10,100 --clients 1,4,16 --requests 200 --ops read,write
+    python bench/bench.py --engine asyncio --lazy --things 1000 --clients 64 --async
+
+The server can only be started once per process: when several Thing counts are given every
+count runs in its own interpreter.
+'''
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+# the host environment of the library lives next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "host"))
+import zenv
+from mozilla.webthing import cbor
+from mozilla.webthing import webserver
+from mozilla.webthing import webthing
+
+OPERATIONS = ("describe", "read", "write", "action", "events")
+
+
+def make_things(count, use_async=False):
+    # Things shaped like a typical sensor/actuator: two properties, an action and an event.
+    # With use_async getters, setters and the action callback are coroutine functions.
+    things = []
+    getter, setter, noop = _getter, _setter, _noop
+    if use_async:
+        getter, setter, noop = _async_getter, _async_setter, _async_noop
+    for i in range(count):
+        state = {"level": 0, "on": False}
+        thing = webthing.Thing("thing%d" % i, "Thing %d" % i, "Benchmark thing")
+        thing.add_property("level", "Level", "integer", getter(state, "level"), setter(state, "level"),
+                           unit="percent")
+        thing.add_property("on", "On", "boolean", getter(state, "on"), setter(state, "on"))
+        thing.add_action("noop", "Noop", noop, input_type="integer")
+        thing.register_event("tick", "Periodic tick")
+        for n in range(4):
+            thing.signal_event("tick", n)
+        things.append(thing)
+    return things
+
+
+def _getter(state, key):
+    return lambda: state[key]
+
+
+def _setter(state, key):
+    def setter(value):
+        state[key] = value
+        return value
+    return setter
+
+
+def _noop(start, value):
+    return value
+
+
+def _async_getter(state, key):
+    async def getter():
+        return state[key]
+    return getter
+
+
+def _async_setter(state, key):
+    async def setter(value):
+        state[key] = value
+        return value
+    return setter
+
+
+async def _async_noop(start, value):
+    return value
+
+
+def _request(op, thing_id, n, use_cbor=False):
+    # Raw bytes of the request performing *op* on the Thing *thing_id*, in JSON or CBOR.
+    if use_cbor:
+        encode = cbor.dumps
+        media = "application/cbor"
+    else:
+        encode = lambda value: json.dumps(value).encode()
+        media = "application/json"
+    body = b""
+    if op == "describe":
+        method, path = "GET", "/%s" % thing_id
+    elif op == "read":
+        method, path = "GET", "/%s/properties/level" % thing_id
+    elif op == "write":
+        method, path = "PUT", "/%s/properties/level" % thing_id
+        body = encode({"level": n % 100})
+    elif op == "action":
+        method, path = "POST", "/%s/actions" % thing_id
+        body = encode({"noop": {"input": n}})
+    elif op == "events":
+        method, path = "GET", "/%s/events/tick?limit=4" % thing_id
+    else:
+        raise ValueError(op)
+    head = "%s %s HTTP/1.1\r\nHost: bench\r\nAccept: %s\r\n" % (method, path, media)
+    if body:
+        head += "Content-Type: %s\r\nContent-Length: %d\r\n" % (media, len(body))
+    return head.encode() + b"\r\n" + body
+
+
+class Client():
+    # Minimal keep-alive HTTP/1.1 client, cheap enough not to dominate the measurements.
+
+    def __init__(self, port):
+        self.port = port
+        self.sock = None
+        self.rfile = None
+
+    def _connect(self):
+        self.sock = socket.create_connection(("127.0.0.1", self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile("rb")
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    def request(self, data):
+        # Send *data* and return the status code, reconnecting once if the server has
+        # closed an idle connection.
+        for attempt in (0, 1):
+            if self.sock is None:
+                self._connect()
+            try:
+                self.sock.sendall(data)
+                return self._response()
+            except (ConnectionError, EOFError):
+                self.close()
+                if attempt:
+                    raise
+
+    def _response(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError
+        code = int(line.split()[1])
+        length = None
+        chunked = False
+        close = False
+        while True:
+            line = self.rfile.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"transfer-encoding":
+                chunked = value == b"chunked"
+            elif name == b"connection":
+                close = value == b"close"
+        if chunked:
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                self.rfile.read(size + 2)
+                if size == 0:
+                    break
+        elif length is not None:
+            self.rfile.read(length)
+        elif code != 304:
+            self.rfile.read()
+            close = True
+        if close:
+            self.close()
+        return code
+
+
+def run_clients(port, op, thing_ids, clients, requests, use_cbor=False):
+    # Run *clients* threads issuing *requests* each; return (elapsed seconds, latencies, errors).
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def client_loop(index):
+        client = Client(port)
+        own = []
+        failed = 0
+        batch = [_request(op, thing_ids[(index + n) % len(thing_ids)], n, use_cbor) for n in range(requests)]
+        barrier.wait()
+        for data in batch:
+            t0 = time.perf_counter()
+            try:
+                code = client.request(data)
+            except Exception:
+                code = 0
+            own.append(time.perf_counter() - t0)
+            if code >= 400 or code == 0:
+                failed += 1
+        client.close()
+        with lock:
+            latencies.extend(own)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies, errors[0]
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+def run(args):
+    port_wanted = args.port
+    zenv.install_socket(webserver, port_wanted)
+    engine = None
+    if args.engine == "asyncio":
+        from mozilla.webthing import aioserver
+        engine = aioserver
+        aioserver.PORT = port_wanted
+    t0 = time.perf_counter()
+    things = make_things(args.things[0], args.use_async)
+    built = time.perf_counter()
+    webthing.run_server(things, workers=args.workers, queue_size=args.queue, lazy=args.lazy, engine=engine)
+    setup_ms = (time.perf_counter() - built) * 1000
+    if engine is None:
+        port = zenv.wait_bound()
+    else:
+        while engine.bound_port is None:
+            time.sleep(0.01)
+        port = engine.bound_port
+    thing_ids = [thing.id for thing in things]
+
+    rows = []
+    for op in args.ops:
+        for clients in args.clients:
+            # warm up caches and connections
+            run_clients(port, op, thing_ids, clients, min(args.requests, 10), args.cbor)
+            elapsed, latencies, errors = run_clients(port, op, thing_ids, clients, args.requests, args.cbor)
+            peak = 0
+            if not args.no_alloc:
+                tracemalloc.start()
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                run_clients(port, op, thing_ids, clients, max(1, args.requests // 4), args.cbor)
+                peak = tracemalloc.get_traced_memory()[1] - base
+                tracemalloc.stop()
+            rows.append({
+                "things": len(things),
+                "op": op,
+                "clients": clients,
+                "requests": len(latencies),
+                "errors": errors,
+                "rps": len(latencies) / elapsed if elapsed else 0.0,
+                "p50_ms": _percentile(latencies, 0.50) * 1000,
+                "p99_ms": _percentile(latencies, 0.99) * 1000,
+                "peak_kib": peak / 1024.0,
+                "construct_ms": (built - t0) * 1000,
+                "setup_ms": setup_ms,
+            })
+    return rows
+
+
+def print_rows(rows):
+    print("%6s %-9s %7s %8s %6s %10s %9s %9s %10s %9s %9s" % (
+        "things", "op", "clients", "requests", "errors", "req/s", "p50 ms", "p99 ms", "peak KiB",
+        "build ms", "setup ms"))
+    for row in rows:
+        print("%6d %-9s %7d %8d %6d %10.1f %9.2f %9.2f %10.1f %9.1f %9.1f" % (
+            row["things"], row["op"], row["clients"], row["requests"], row["errors"], row["rps"],
+            row["p50_ms"], row["p99_ms"], row["peak_kib"], row["construct_ms"], row["setup_ms"]))
+
+
+def _int_list(text):
+    return [int(x) for x in text.split(",") if x]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--things", type=_int_list, default=[1, 10, 100],
+                        help="comma separated numbers of Things (default 1,10,100)")
+    parser.add_argument("--clients", type=_int_list, default=[1, 4, 16],
+                        help="comma separated numbers of concurrent clients (default 1,4,16)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per client (default 200)")
+    parser.add_argument("--ops", type=lambda s: [x for x in s.split(",") if x], default=list(OPERATIONS),
+                        help="comma separated operations among %s" % ",".join(OPERATIONS))
+    parser.add_argument("--workers", type=int, default=4, help="webserver worker threads (default 4)")
+    parser.add_argument("--queue", type=int, default=16, help="webserver accept queue size (default 16)")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on (default any free port)")
+    parser.add_argument("--lazy", action="store_true", help="resolve the routes of every Thing on demand")
+    parser.add_argument("--cbor", action="store_true", help="send and accept CBOR instead of JSON")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads",
+                        help="serve with webserver (threads, default) or aioserver (asyncio)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="coroutine getters, setters and action callbacks (asyncio engine only)")
+    parser.add_argument("--no-alloc", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON lines")
+    args = parser.parse_args()
+    for op in args.ops:
+        if op not in OPERATIONS:
+            parser.error("unknown operation %s" % op)
+    if args.use_async and args.engine != "asyncio":
+        parser.error("--async needs --engine asyncio")
+
+    if len(args.things) == 1:
+        rows = run(args)
+    else:
+        rows = []
+        for count in args.things:
+            cmd = [sys.executable, os.path.abspath(__file__), "--json", "--things", str(count)]
+            for name in ("clients", "ops"):
+                cmd += ["--" + name, ",".join(str(x) for x in getattr(args, name))]
+            cmd += ["--requests", str(args.requests), "--workers", str(args.workers),
+                    "--queue", str(args.queue), "--port", str(args.port), "--engine", args.engine]
+            if args.lazy:
+                cmd.append("--lazy")
+            if args.cbor:
+                cmd.append("--cbor")
+            if args.use_async:
+                cmd.append("--async")
+            if args.no_alloc:
+                cmd.append("--no-alloc")
+            out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            rows += [json.loads(line) for line in out.splitlines() if line.startswith("{")]
+
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        print_rows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+'''
+Host benchmark of the event forwarder against a local stand-in collector.
+
+A Thing signals events and property changes at a given rate while a Forwarder sends them to an
+HTTP/1.1 collector running in the same process. The collector can refuse the first requests
+with 503 or start late, to exercise retries and the drop-oldest queue. The report lists records
+signalled, delivered and dropped, requests, connections opened and bytes received.
+
+    python bench/forward.py
+    python bench/forward.py --records 1000 --rate 500 --batch-size 32 --fail 3 --outage 2000
+'''
+
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+# the host environment of the library lives next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "host"))
+import zenv
+from mozilla.webthing import cbor
+from mozilla.webthing import forwarder
+from mozilla.webthing import webthing
+
+
+class Collector(http.server.ThreadingHTTPServer):
+    # Stand-in collector accepting batches on persistent connections.
+
+    daemon_threads = True
+
+    def __init__(self, fail=0):
+        self.records = []
+        self.requests = 0
+        self.connections = 0
+        self.received = 0
+        self.fail = fail
+        self.lock = threading.Lock()
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), _CollectorHandler)
+
+
+class _CollectorHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        collector = self.server
+        with collector.lock:
+            collector.requests += 1
+            collector.received += len(body)
+            refuse = collector.fail > 0
+            if refuse:
+                collector.fail -= 1
+            elif "cbor" in self.headers.get("Content-Type", ""):
+                collector.records.extend(cbor.loads(body))
+            else:
+                collector.records.extend(json.loads(body))
+        if refuse:
+            self.send_response(503)
+        else:
+            self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def run(args):
+    zenv.install_socket(forwarder)
+    collector = Collector(args.fail)
+    port = collector.server_address[1]
+    if args.outage:
+        threading.Timer(args.outage / 1000.0, collector.serve_forever).start()
+    else:
+        threading.Thread(target=collector.serve_forever, daemon=True).start()
+
+    fwd = forwarder.Forwarder("http://127.0.0.1:%d/ingest" % port, batch_size=args.batch_size,
+                              batch_interval=args.interval, queue_size=args.queue_size,
+                              retry_min=args.retry_min, retry_max=args.retry_max, encoding=args.encoding)
+    state = {"level": 0}
+    thing = webthing.Thing("fwd", "Forwarded", forwarder=fwd)
+    thing.register_event("tick", "Periodic tick")
+    thing.add_property("level", "Level", "integer", lambda: state["level"], lambda v: v)
+
+    start = time.perf_counter()
+    for n in range(args.records):
+        if n % 2:
+            thing.signal_event("tick", n)
+        else:
+            thing._write_properties({"level": n})
+        if args.rate:
+            time.sleep(1.0 / args.rate)
+    signalled = time.perf_counter()
+    deadline = time.time() + args.drain / 1000.0
+    while fwd.sent + fwd.dropped + fwd.rejected < args.records and time.time() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    collector.shutdown()
+
+    return {
+        "records": args.records,
+        "delivered": len(collector.records),
+        "sent": fwd.sent,
+        "dropped": fwd.dropped,
+        "pending": fwd.pending(),
+        "requests": fwd.requests,
+        "failures": fwd.failures,
+        "connections": collector.connections,
+        "bytes": collector.received,
+        "signal_s": signalled - start,
+        "total_s": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=500, help="events and property changes (default 500)")
+    parser.add_argument("--rate", type=float, default=200, help="records per second, 0 for no pause (default 200)")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--interval", type=int, default=200, help="batch interval in milliseconds (default 200)")
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--retry-min", type=int, default=100)
+    parser.add_argument("--retry-max", type=int, default=2000)
+    parser.add_argument("--encoding", choices=("json", "cbor"), default="json")
+    parser.add_argument("--fail", type=int, default=0, help="requests the collector refuses with 503 first")
+    parser.add_argument("--outage", type=int, default=0, help="milliseconds before the collector starts")
+    parser.add_argument("--drain", type=int, default=10000, help="milliseconds allowed for emptying the queue")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+    result = run(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key in result:
+            value = result[key]
+            if isinstance(value, float):
+                print("%-12s %.3f" % (key, value))
+            else:
+                print("%-12s %d" % (key, value))
+
+
+if __name__ == "__main__":
+    main()
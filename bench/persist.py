@@ -0,0 +1,142 @@
+'''
+Host benchmark of the journal saving the state of Things across reboots.
+
+Things journal to a real file through :class:`journal.FileBackend`, standing in for the flash of
+the device. A workload of property writes, events and action requests runs at a given rate; then
+the Things are created again from the journal, as after a reset, and their state is checked.
+The report lists changes logged and coalesced, writes and bytes written against what writing
+every change at once would cost, compactions, journal size and recovery time.
+
+    python bench/persist.py
+    python bench/persist.py --things 10 --changes 5000 --rate 0 --flush-interval 500 --compact-size 8192
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# the host environment of the library lives next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "host"))
+import zenv
+from mozilla.webthing import journal
+from mozilla.webthing import webthing
+
+
+def make_things(count, store, jrn):
+    # Things with a writable property, a sampled-like read-only one, an action and an event.
+    things = []
+    for i in range(count):
+        state = store.setdefault(i, {"level": 0})
+        thing = webthing.Thing("thing%d" % i, "Thing %d" % i, journal=jrn, action_history=8)
+        thing.add_property("level", "Level", "integer", _getter(state), _setter(state))
+        thing.add_action("noop", "Noop", _noop, input_type="integer")
+        thing.register_event("tick", "Periodic tick", history=8)
+        things.append(thing)
+    return things
+
+
+def _getter(state):
+    return lambda: state["level"]
+
+
+def _setter(state):
+    def setter(value):
+        state["level"] = value
+        return value
+    return setter
+
+
+def _noop(start, value):
+    return value
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix="webthing-journal-")
+    path = os.path.join(directory, "journal")
+    options = {"flush_interval": args.flush_interval, "flush_size": args.flush_size,
+               "compact_size": args.compact_size}
+
+    jrn = journal.Journal(journal.FileBackend(path), **options)
+    store = {}
+    things = make_things(args.things, store, jrn)
+    start = time.perf_counter()
+    for n in range(args.changes):
+        thing = things[n % len(things)]
+        kind = (n // len(things)) % 4
+        if kind == 0 or kind == 2:
+            thing._write_properties({"level": n})
+        elif kind == 1:
+            thing.signal_event("tick", n)
+        else:
+            thing._dispatch_action((True, ), {"noop": {"input": n}})
+        if args.rate:
+            time.sleep(1.0 / args.rate)
+    # let the action workers finish before the final flush
+    time.sleep(0.2)
+    jrn.flush()
+    elapsed = time.perf_counter() - start
+
+    expected = {}
+    for thing in things:
+        history = thing.events["tick"][1].items()
+        expected[thing.id] = (store[things.index(thing)]["level"], history,
+                              [request[2]["status"] for request in thing.action_request.items()])
+
+    # a reboot: a new journal over the same file, and the same Things created again
+    t0 = time.perf_counter()
+    recovered = journal.Journal(journal.FileBackend(path), **options)
+    after = {}
+    things = make_things(args.things, after, recovered)
+    recovery = time.perf_counter() - t0
+    mismatches = 0
+    for i, thing in enumerate(things):
+        level, history, statuses = expected[thing.id]
+        restored = [tuple(record) for record in thing.events["tick"][1].items()]
+        if after[i]["level"] != level or restored != history:
+            mismatches += 1
+        elif len(thing.action_request.items()) != len(statuses):
+            mismatches += 1
+
+    return {
+        "changes": jrn.logged,
+        "coalesced": jrn.coalesced,
+        "writes": jrn.writes,
+        "bytes_logged": jrn.bytes_logged,
+        "bytes_written": jrn.bytes_written,
+        "amplification": jrn.bytes_written / float(jrn.bytes_logged or 1),
+        "writes_per_change": jrn.writes / float(jrn.logged or 1),
+        "compactions": jrn.compactions,
+        "journal_bytes": os.path.getsize(path),
+        "workload_s": elapsed,
+        "recovery_ms": recovery * 1000,
+        "mismatches": mismatches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--things", type=int, default=4)
+    parser.add_argument("--changes", type=int, default=2000, help="property writes, events and actions")
+    parser.add_argument("--rate", type=float, default=1000, help="changes per second, 0 for no pause (default 1000)")
+    parser.add_argument("--flush-interval", type=int, default=200, help="milliseconds (default 200)")
+    parser.add_argument("--flush-size", type=int, default=1024, help="bytes (default 1024)")
+    parser.add_argument("--compact-size", type=int, default=16384, help="bytes (default 16384)")
+    parser.add_argument("--json", action="store_true", help="print the result as JSON")
+    args = parser.parse_args()
+    result = run(args)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for key in result:
+            value = result[key]
+            if isinstance(value, float):
+                print("%-18s %.3f" % (key, value))
+            else:
+                print("%-18s %d" % (key, value))
+
+
+if __name__ == "__main__":
+    main()
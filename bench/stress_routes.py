@@ -0,0 +1,144 @@
+'''
+Stress test of route registration while the webserver is serving requests.
+
+Client threads keep requesting routes that never change, and routes that other threads keep
+registering and removing: exact routes, parameterised routes and dispatchers. Stable routes
+must always answer 200 and toggled routes 200, 404 or 405, whatever the interleaving; once the
+writers stop, every toggled route must be gone and the route count back to where it started.
+The exit status is 1 if any check fails.
+
+    python bench/stress_routes.py
+    python bench/stress_routes.py --seconds 10 --clients 8 --writers 4
+'''
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+# the host environment of the library lives next to this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "host"))
+import zenv
+from bench import Client
+from mozilla.webthing import webserver
+
+
+def _ok(static_args, payload):
+    return {"args": list(static_args)}
+
+
+def _dispatch(static_args, rest):
+    if rest == "/item":
+        return ({"get": (_ok, static_args, "/dispatched/item")}, ())
+    return (None, None)
+
+
+def _toggled_paths(index):
+    return ["/toggled%d" % index, "/toggled/%d/x" % index, "/dispatched%d/item" % index]
+
+
+def writer(index, stop, counts):
+    # Register and remove the routes of this writer until stop is set. Methods are given in
+    # upper case on removal, as callers are free to do.
+    n = 0
+    while not stop.is_set():
+        webserver.register_handler("/toggled%d" % index, "get", _ok, (index, ))
+        webserver.register_handler("/toggled/{n}/x", "put", _ok)
+        webserver.register_handler("/toggled/%d/{n}" % index, "get", _ok, (index, ))
+        webserver.register_dispatcher("/dispatched%d" % index, _dispatch, (index, ))
+        webserver.register_handlers([("/bulk%d/%d" % (index, i), "post", _ok, ()) for i in range(8)])
+        time.sleep(0)
+        webserver.remove_handler("/toggled%d" % index, "GET")
+        webserver.remove_handler("/toggled/%d/{n}" % index, "GET")
+        webserver.remove_dispatcher("/dispatched%d" % index)
+        for i in range(8):
+            webserver.remove_handler("/bulk%d/%d" % (index, i), "Post")
+        n += 1
+    counts[index] = n
+
+
+def client(port, writers, stop, failures, served):
+    c = Client(port)
+    n = 0
+    while not stop.is_set():
+        stable = n % 2 == 0
+        if stable:
+            path = ("/stable", "/stable/%d" % n, "/fixed/item")[n % 3]
+        else:
+            path = _toggled_paths((n // 2) % writers)[n % 3]
+        data = ("GET %s HTTP/1.1\r\nHost: stress\r\n\r\n" % path).encode()
+        try:
+            code = c.request(data)
+        except Exception as e:
+            code = repr(e)
+        if (stable and code != 200) or (not stable and code not in (200, 404, 405)):
+            failures.append((path, code))
+        n += 1
+    c.close()
+    served.append(n)
+
+
+def run(args):
+    zenv.install_socket(webserver, args.port)
+    # 404s are expected here by the thousands
+    webserver.print = lambda *args: None
+    webserver.register_handler("/stable", "get", _ok)
+    webserver.register_handler("/stable/{n}", "get", _ok)
+    webserver.register_handler("/toggled/{n}/x", "put", _ok)
+    webserver.register_dispatcher("/fixed", _dispatch)
+    baseline = webserver._route_count()
+    thread(webserver.start, args.workers, args.clients)
+    port = zenv.wait_bound()
+
+    stop_writers = threading.Event()
+    stop_clients = threading.Event()
+    failures = []
+    served = []
+    counts = [0] * args.writers
+    writers = [threading.Thread(target=writer, args=(i, stop_writers, counts)) for i in range(args.writers)]
+    clients = [threading.Thread(target=client, args=(port, args.writers, stop_clients, failures, served))
+               for i in range(args.clients)]
+    for t in writers + clients:
+        t.start()
+    time.sleep(args.seconds)
+    stop_writers.set()
+    for t in writers:
+        t.join()
+    stop_clients.set()
+    for t in clients:
+        t.join()
+
+    problems = ["%s answered %s" % failure for failure in failures[:10]]
+    if webserver._route_count() != baseline:
+        problems.append("%d routes left, %d expected" % (webserver._route_count(), baseline))
+    c = Client(port)
+    for index in range(args.writers):
+        for path in _toggled_paths(index):
+            code = c.request(("GET %s HTTP/1.1\r\nHost: stress\r\n\r\n" % path).encode())
+            if code != 404 and code != 405:
+                problems.append("%s still answered %d" % (path, code))
+    c.close()
+
+    print("requests     %d" % sum(served))
+    print("updates      %d" % sum(counts))
+    print("failures     %d" % len(failures))
+    for problem in problems:
+        print(problem)
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=3, help="duration of the test (default 3)")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent clients (default 4)")
+    parser.add_argument("--writers", type=int, default=2, help="threads changing routes (default 2)")
+    parser.add_argument("--workers", type=int, default=4, help="webserver worker threads (default 4)")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on (default any free port)")
+    args = parser.parse_args()
+    if not run(args):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
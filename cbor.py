@@ -0,0 +1,242 @@
+'''
+Concise Binary Object Representation (RFC 8949) of the values exchanged by the webserver.
+'''
+
+import struct
+
+_UNSIGNED = 0
+_NEGATIVE = 1
+_BYTES = 2
+_TEXT = 3
+_ARRAY = 4
+_MAP = 5
+_TAG = 6
+_SIMPLE = 7
+
+_FALSE = b"\xf4"
+_TRUE = b"\xf5"
+_NULL = b"\xf6"
+_BREAK = 0xff
+
+
+def encode(value, write):
+    '''
+.. function:: encode(value, write)
+
+    Encode *value* piece by piece, calling *write* with every piece of bytes. *value* can be
+    None, a bool, an int fitting in 64 bits, a float, a str, bytes, a list, a tuple or a dict
+    of such values. Floats are sent in single precision when that does not lose information.
+    '''
+    if value is None:
+        write(_NULL)
+    elif value is True:
+        write(_TRUE)
+    elif value is False:
+        write(_FALSE)
+    elif isinstance(value, int):
+        if value >= 0:
+            _write_head(_UNSIGNED, value, write)
+        else:
+            _write_head(_NEGATIVE, -1 - value, write)
+    elif isinstance(value, float):
+        try:
+            single = struct.pack(">f", value)
+        except OverflowError:
+            # out of the single precision range
+            single = None
+        if single is not None and (value != value or struct.unpack(">f", single)[0] == value):
+            write(b"\xfa" + single)
+        else:
+            write(b"\xfb" + struct.pack(">d", value))
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        _write_head(_TEXT, len(data), write)
+        write(data)
+    elif isinstance(value, bytes) or isinstance(value, bytearray):
+        _write_head(_BYTES, len(value), write)
+        write(value)
+    elif isinstance(value, list) or isinstance(value, tuple):
+        _write_head(_ARRAY, len(value), write)
+        for item in value:
+            encode(item, write)
+    elif isinstance(value, dict):
+        _write_head(_MAP, len(value), write)
+        for key in value:
+            encode(key, write)
+            encode(value[key], write)
+    else:
+        raise TypeError
+
+
+def dumps(value):
+    '''
+.. function:: dumps(value)
+
+    Return the encoding of *value* as bytes, see :func:`encode`.
+    '''
+    res = bytearray()
+    encode(value, res.extend)
+    return bytes(res)
+
+
+def loads(data):
+    '''
+.. function:: loads(data)
+
+    Decode the single data item in *data* (bytes or bytearray). Byte strings are returned as
+    bytes, maps as dicts, and tags are skipped, returning the tagged item. A ValueError is raised
+    if *data* is not well-formed or contains more than one item.
+    '''
+    try:
+        value, pos = _decode(data, 0)
+    except (IndexError, TypeError, UnicodeError, struct.error, RecursionError):
+        # truncated or too deeply nested items
+        raise ValueError
+    if value is _BREAK_MARK or pos != len(data):
+        raise ValueError
+    return value
+
+
+def _write_head(major, n, write):
+    major = major << 5
+    if n < 24:
+        write(bytearray((major | n, )))
+    elif n < 0x100:
+        write(bytearray((major | 24, n)))
+    elif n < 0x10000:
+        write(bytearray((major | 25, n >> 8, n & 0xff)))
+    elif n < 0x100000000:
+        write(bytearray((major | 26, n >> 24, (n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff)))
+    elif n < 0x10000000000000000:
+        head = bytearray(9)
+        head[0] = major | 27
+        for i in range(8):
+            head[8 - i] = (n >> (8 * i)) & 0xff
+        write(head)
+    else:
+        raise ValueError
+
+
+# returned by _decode() for the "break" stop code ending indefinite-length items
+_BREAK_MARK = object()
+
+
+def _decode(data, pos):
+    # Decode the item starting at data[pos] and return a tuple (value, position after it).
+    initial = data[pos]
+    major = initial >> 5
+    info = initial & 0x1f
+    pos += 1
+
+    if major == _SIMPLE:
+        if info == 20:
+            return (False, pos)
+        if info == 21:
+            return (True, pos)
+        if info == 22 or info == 23:
+            return (None, pos)
+        if info == 25:
+            return (_half((data[pos] << 8) | data[pos + 1]), pos + 2)
+        if info == 26:
+            return (struct.unpack(">f", bytes(data[pos:pos + 4]))[0], pos + 4)
+        if info == 27:
+            return (struct.unpack(">d", bytes(data[pos:pos + 8]))[0], pos + 8)
+        if info == 31:
+            return (_BREAK_MARK, pos)
+        raise ValueError
+
+    if info == 31:
+        if major == _BYTES or major == _TEXT:
+            chunks = bytearray()
+            while True:
+                chunk, pos = _decode(data, pos)
+                if chunk is _BREAK_MARK:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                chunks.extend(chunk)
+            if major == _TEXT:
+                return (chunks.decode("utf-8"), pos)
+            return (bytes(chunks), pos)
+        if major == _ARRAY:
+            items = []
+            while True:
+                item, pos = _decode(data, pos)
+                if item is _BREAK_MARK:
+                    return (items, pos)
+                items.append(item)
+        if major == _MAP:
+            items = {}
+            while True:
+                key, pos = _decode(data, pos)
+                if key is _BREAK_MARK:
+                    return (items, pos)
+                value, pos = _decode(data, pos)
+                if value is _BREAK_MARK:
+                    raise ValueError
+                items[key] = value
+        raise ValueError
+
+    if info < 24:
+        n = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        if pos + size > len(data):
+            raise ValueError
+        n = 0
+        for i in range(size):
+            n = (n << 8) | data[pos + i]
+        pos += size
+    else:
+        raise ValueError
+
+    if major == _UNSIGNED:
+        return (n, pos)
+    if major == _NEGATIVE:
+        return (-1 - n, pos)
+    if major == _BYTES or major == _TEXT:
+        if pos + n > len(data):
+            raise ValueError
+        chunk = bytes(data[pos:pos + n])
+        if major == _TEXT:
+            chunk = chunk.decode("utf-8")
+        return (chunk, pos + n)
+    if major == _ARRAY:
+        items = []
+        for i in range(n):
+            item, pos = _decode(data, pos)
+            if item is _BREAK_MARK:
+                raise ValueError
+            items.append(item)
+        return (items, pos)
+    if major == _MAP:
+        items = {}
+        for i in range(n):
+            key, pos = _decode(data, pos)
+            value, pos = _decode(data, pos)
+            if key is _BREAK_MARK or value is _BREAK_MARK:
+                raise ValueError
+            items[key] = value
+        return (items, pos)
+    # a tag: the tagged item is returned as it is
+    value, pos = _decode(data, pos)
+    if value is _BREAK_MARK:
+        raise ValueError
+    return (value, pos)
+
+
+def _half(h):
+    exp = (h >> 10) & 0x1f
+    mant = h & 0x3ff
+    if exp == 0:
+        value = mant * 2.0 ** -24
+    elif exp == 31:
+        if mant:
+            value = float("nan")
+        else:
+            value = float("inf")
+    else:
+        value = (mant + 1024) * 2.0 ** (exp - 25)
+    if h & 0x8000:
+        return -value
+    return value
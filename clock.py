@@ -0,0 +1,167 @@
+'''
+Local wall clock for event timestamps.
+'''
+
+import timers
+
+_DAY = 86400000
+
+
+class Clock():
+    '''
+====
+Clock class
+====
+
+.. class:: Clock(source=None, interval=3600000, retry=10000)
+
+    A wall clock obtained by adding an offset to the monotonic milliseconds counter of the
+    device. The offset is computed by :meth:`sync` from the time returned by *source*, so
+    reading the clock never performs any I/O.
+
+    * *source* is a function returning the current time, either as seconds since the Unix epoch
+        or as an ISO-8601 string such as ``"2018-12-01T23:59:48Z"``. It can be slow (an HTTP or
+        NTP request), since it is only called when synchronising.
+    * *interval* is the number of milliseconds between two synchronisations done by :meth:`start`.
+    * *retry* is the number of milliseconds to wait before trying again after a failed synchronisation.
+
+    Until the first successful synchronisation the clock counts from the Unix epoch.
+    '''
+
+    def __init__(self, source=None, interval=3600000, retry=10000):
+        self.source = source
+        self.interval = interval
+        self.retry = retry
+        self.offset = 0
+        self.synced = False
+        # (day number, formatted date) of the last formatted timestamp
+        self._date = (None, None)
+
+    def start(self):
+        '''
+.. method:: start()
+
+    Synchronise the clock in a background thread, every *interval* milliseconds.
+        '''
+        if self.source is not None:
+            thread(self._run)
+
+    def _run(self):
+        while True:
+            if self.sync():
+                sleep(self.interval)
+            else:
+                sleep(self.retry)
+
+    def sync(self):
+        '''
+.. method:: sync()
+
+    Read the time from *source* and update the offset. Return True on success.
+        '''
+        if self.source is None:
+            return False
+        try:
+            before = timers.now()
+            value = self.source()
+            after = timers.now()
+            if value is None:
+                return False
+            if isinstance(value, str):
+                value = parse_iso8601(value)
+            else:
+                value = int(value * 1000)
+        except Exception as e:
+            print("Error while synchronising clock")
+            print(e)
+            return False
+        # the time was most likely read halfway through the call
+        self.offset = value - (before + after) // 2
+        self.synced = True
+        return True
+
+    def now(self):
+        '''
+.. method:: now()
+
+    Return the current time as milliseconds since the Unix epoch.
+        '''
+        return timers.now() + self.offset
+
+    def isoformat(self, ms=None):
+        '''
+.. method:: isoformat(ms=None)
+
+    Return the time *ms* (milliseconds since the Unix epoch, default the current time) as an
+    ISO-8601 UTC string with millisecond precision, e.g. ``"2018-12-01T23:59:48.293Z"``.
+    The date part is computed once per day.
+        '''
+        if ms is None:
+            ms = self.now()
+        day = ms // _DAY
+        date = self._date
+        if date[0] != day:
+            y, m, d = _civil_from_days(day)
+            date = (day, "%04d-%02d-%02dT" % (y, m, d))
+            self._date = date
+        rest = ms - day * _DAY
+        secs = rest // 1000
+        return "%s%02d:%02d:%02d.%03dZ" % (date[1], secs // 3600, (secs // 60) % 60, secs % 60, rest % 1000)
+
+
+def parse_iso8601(text):
+    '''
+.. function:: parse_iso8601(text)
+
+    Convert an ISO-8601 date and time such as ``"2018-12-01T23:59:48.293498+01:00"`` to
+    milliseconds since the Unix epoch. A missing time zone is taken as UTC.
+    '''
+    text = text.strip()
+    ms = _days_from_civil(int(text[0:4]), int(text[5:7]), int(text[8:10])) * _DAY
+    ms += (int(text[11:13]) * 3600 + int(text[14:16]) * 60 + int(text[17:19])) * 1000
+    i = 19
+    if i < len(text) and text[i] == ".":
+        i += 1
+        start = i
+        while i < len(text) and text[i] >= "0" and text[i] <= "9":
+            i += 1
+        ms += int((text[start:i] + "00")[:3])
+    if i < len(text) and (text[i] == "+" or text[i] == "-"):
+        zone = (int(text[i + 1:i + 3]) * 60 + int(text[i + 4:i + 6])) * 60000
+        if text[i] == "+":
+            ms -= zone
+        else:
+            ms += zone
+    return ms
+
+
+def _days_from_civil(y, m, d):
+    # days since 1970-01-01 of a proleptic Gregorian date
+    if m <= 2:
+        y -= 1
+    era = y // 400
+    yoe = y - era * 400
+    if m > 2:
+        doy = (153 * (m - 3) + 2) // 5 + d - 1
+    else:
+        doy = (153 * (m + 9) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _civil_from_days(z):
+    z += 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    if mp < 10:
+        m = mp + 3
+    else:
+        m = mp - 9
+    y = yoe + era * 400
+    if m <= 2:
+        y += 1
+    return (y, m, d)
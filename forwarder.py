@@ -0,0 +1,340 @@
+'''
+Batched forwarding of events and property changes to a collector over HTTP.
+'''
+
+import socket
+import json
+import threading
+import timers
+from mozilla.webthing import cbor
+
+# longest sleep, in milliseconds, of the forwarding thread
+FORWARD_TICK = 100
+# size in bytes of the buffer responses of the collector are read through
+_RESPONSE_BUFFER_SIZE = 256
+
+
+class Forwarder():
+    '''
+====
+Forwarder class
+====
+
+.. class:: Forwarder(url, batch_size=16, batch_interval=1000, queue_size=64, retry_min=500, retry_max=30000, timeout=5000, encoding="json")
+
+    Send records to a collector in batches, with one ``POST`` request per batch on a persistent
+    connection. A Thing created with ``forwarder=`` pushes a record for every emitted event and
+    every property change, as the WebSocket message it would send:
+    ``{"thing": <thing id>, "messageType": "event", "data": {<event id>: {"data": ..., "timestamp": ...}}}``
+    or ``{"thing": ..., "messageType": "propertyStatus", "data": {<property id>: <value>}, "timestamp": ...}``.
+
+    * *url* is the address of the collector, ``http://<host>[:<port>]/<path>``.
+    * *batch_size* is the number of records that triggers sending a batch.
+    * *batch_interval* is the number of milliseconds after which a record is sent even if its batch is
+        not full.
+    * *queue_size* is the number of records kept while the collector cannot be reached; when it is
+        exceeded the oldest records are dropped.
+    * *retry_min* and *retry_max* bound the number of milliseconds waited before sending again a batch
+        that failed; the wait doubles at every consecutive failure.
+    * *timeout* is the number of milliseconds allowed for connecting and for every socket operation.
+    * *encoding* is ``"json"`` or ``"cbor"``: batches are sent as a JSON or CBOR array of records.
+
+    Batches answered with a 2xx status are done. Batches refused with another 4xx status (except
+    408 and 429) are dropped, since sending them again would not help; on any other failure the
+    connection is closed and the batch is sent again later.
+    The counters ``sent``, ``dropped``, ``rejected``, ``requests``, ``failures`` and ``connections``
+    report the records delivered, dropped from a full queue and refused, the requests made, the
+    failed ones and the connections opened.
+    '''
+
+    def __init__(self, url, batch_size=16, batch_interval=1000, queue_size=64, retry_min=500, retry_max=30000,
+                 timeout=5000, encoding="json"):
+        if not url.startswith("http://"):
+            raise ValueError
+        rest = url[7:]
+        slash = rest.find("/")
+        if slash < 0:
+            self.path = "/"
+        else:
+            self.path = rest[slash:]
+            rest = rest[:slash]
+        colon = rest.find(":")
+        if colon < 0:
+            self.host = rest
+            self.port = 80
+        else:
+            self.host = rest[:colon]
+            self.port = int(rest[colon + 1:])
+        if encoding == "json":
+            self.content_type = "application/json"
+        elif encoding == "cbor":
+            self.content_type = "application/cbor"
+        else:
+            raise ValueError
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.queue_size = queue_size
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.timeout = timeout
+
+        # records waiting to be sent, oldest first, not including the batch being sent
+        self._queue = []
+        # arrival time of the oldest queued record
+        self._since = None
+        self._lock = threading.Lock()
+        # released when a record arrives in the empty queue, so that the thread sleeps while idle
+        self._arrived = threading.Semaphore(0)
+        self._sock = None
+        self._buf = bytearray(_RESPONSE_BUFFER_SIZE)
+        self._start = 0
+        self._end = 0
+        # bytes received on all connections, telling whether a failed request got any response
+        self._received = 0
+        self._running = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.requests = 0
+        self.failures = 0
+        self.connections = 0
+
+    def start(self):
+        '''
+.. method:: start()
+
+    Start the thread sending the batches.
+        '''
+        if not self._running:
+            self._running = True
+            thread(self._run)
+
+    def push(self, record):
+        '''
+.. method:: push(record)
+
+    Queue *record*, a value that can be encoded as JSON (or CBOR), for sending. Never blocks:
+    when the queue is full the oldest record is dropped. A record that cannot be encoded is
+    left out of its batch and counted as rejected.
+        '''
+        self._lock.acquire()
+        try:
+            if len(self._queue) >= self.queue_size:
+                self._queue.pop(0)
+                self.dropped += 1
+            self._queue.append(record)
+            first = self._since is None
+            if first:
+                self._since = timers.now()
+        finally:
+            self._lock.release()
+        if first:
+            self._arrived.release()
+
+    def pending(self):
+        '''
+.. method:: pending()
+
+    Return the number of records waiting to be sent, not counting the batch being sent.
+        '''
+        return len(self._queue)
+
+    def _run(self):
+        retry = 0
+        while True:
+            self._lock.acquire()
+            count = len(self._queue)
+            batch = None
+            wait = FORWARD_TICK
+            if count >= self.batch_size or (count and timers.now() - self._since >= self.batch_interval):
+                batch = self._queue[:self.batch_size]
+                del self._queue[:self.batch_size]
+                if self._queue:
+                    self._since = timers.now()
+                else:
+                    self._since = None
+            elif count:
+                wait = min(wait, max(self.batch_interval - (timers.now() - self._since), 1))
+            self._lock.release()
+
+            if batch is None:
+                if count:
+                    sleep(wait)
+                else:
+                    self._arrived.acquire()
+                continue
+
+            try:
+                retry = self._forward(batch, retry)
+            except Exception as e:
+                # nothing may stop the thread, or every later record would be lost
+                print("Error while forwarding records")
+                print(e)
+                self._close()
+                retry = 0
+
+    def _forward(self, batch, retry):
+        # Send a batch taken from the queue and return the next retry delay.
+        body, batch = self._encode(batch)
+        if not batch:
+            return retry
+        code = self._send(body)
+        if code is not None and code >= 200 and code < 300:
+            self.sent += len(batch)
+            retry = 0
+        elif code is not None and code >= 400 and code < 500 and code != 408 and code != 429:
+            self.rejected += len(batch)
+            retry = 0
+        else:
+            self.failures += 1
+            self._close()
+            self._requeue(batch)
+            if retry == 0:
+                retry = self.retry_min
+            else:
+                retry = min(retry * 2, self.retry_max)
+            sleep(retry)
+        return retry
+
+    def _encode(self, batch):
+        # Return a tuple (body, batch): the encoded batch, without the records that cannot be
+        # encoded, which are counted as rejected.
+        try:
+            return (self._dumps(batch), batch)
+        except Exception:
+            pass
+        good = []
+        for record in batch:
+            try:
+                self._dumps([record])
+                good.append(record)
+            except Exception as e:
+                print("Error encoding a record")
+                print(e)
+                self.rejected += 1
+        if not good:
+            return (None, good)
+        return (self._dumps(good), good)
+
+    def _dumps(self, batch):
+        if self.content_type == "application/cbor":
+            return cbor.dumps(batch)
+        return json.dumps(batch).encode("utf-8")
+
+    def _requeue(self, batch):
+        # Put a batch that could not be sent back in front of the queue, dropping its oldest
+        # records if newer ones have taken their room meanwhile.
+        self._lock.acquire()
+        try:
+            room = self.queue_size - len(self._queue)
+            if room < len(batch):
+                self.dropped += len(batch) - max(room, 0)
+                batch = batch[len(batch) - max(room, 0):]
+            if batch:
+                self._queue[0:0] = batch
+                if self._since is None:
+                    self._since = timers.now()
+        finally:
+            self._lock.release()
+
+    def _send(self, body):
+        # POST an encoded batch and return the status code of the response, or None if the
+        # request failed.
+        head = ("POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n"
+                % (self.path, self.host, self.content_type, len(body)))
+        data = head.encode("utf-8") + body
+        while True:
+            # the collector may have closed the connection kept from the previous batch while it
+            # was idle: a request failing there before any response arrives is sent again, once,
+            # on a new connection
+            reused = self._sock is not None
+            received = self._received
+            self.requests += 1
+            try:
+                if not reused:
+                    self._connect()
+                self._sock.sendall(data)
+                return self._read_response()
+            except Exception as e:
+                if reused and self._received == received:
+                    self._close()
+                    continue
+                print("Error while forwarding records")
+                print(e)
+                return None
+
+    def _connect(self):
+        sock = socket.socket()
+        sock.settimeout(self.timeout)
+        sock.connect((self.host, self.port))
+        self._sock = sock
+        self._start = 0
+        self._end = 0
+        self.connections += 1
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except Exception:
+                pass
+            self._sock = None
+
+    def _read_response(self):
+        line = self._readline()
+        parts = line.split(" ")
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ValueError
+        code = int(parts[1])
+        length = 0
+        close = parts[0] == "HTTP/1.0"
+        while True:
+            line = self._readline()
+            if not line:
+                break
+            colon = line.find(":")
+            name = line[:colon].lower()
+            value = line[colon + 1:].strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection":
+                close = value == "close"
+            elif name == "transfer-encoding":
+                # responses of the collector are expected to be small and of known length
+                close = True
+        while length > 0:
+            if self._start == self._end:
+                self._fill()
+            n = min(length, self._end - self._start)
+            self._start += n
+            length -= n
+        if close:
+            self._close()
+        return code
+
+    def _fill(self):
+        if self._start > 0:
+            n = self._end - self._start
+            self._buf[0:n] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = n
+        if self._end == len(self._buf):
+            raise ValueError
+        n = self._sock.recv_into(self._buf, len(self._buf) - self._end, 0, self._end)
+        if n == 0:
+            raise IOError
+        self._end += n
+        self._received += n
+
+    def _readline(self):
+        while True:
+            eol = self._buf.find(b"\n", self._start, self._end)
+            if eol >= 0:
+                stop = eol
+                if stop > self._start and self._buf[stop - 1] == 13:
+                    stop -= 1
+                line = self._buf[self._start:stop].decode("utf-8")
+                self._start = eol + 1
+                return line
+            self._fill()
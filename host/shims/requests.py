@@ -0,0 +1,46 @@
+# Host stand-in for the Zerynth requests module, covering get and post over http.client.
+
+import http.client
+import json as _json
+
+
+class Response():
+
+    def __init__(self, status, headers, content):
+        self.status = status
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return _json.loads(self.content)
+
+
+def _request(method, url, data=None, json=None, headers=None, timeout=10):
+    scheme, rest = url.split("://", 1)
+    host, _, path = rest.partition("/")
+    cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+    conn = cls(host, timeout=timeout)
+    headers = dict(headers or {})
+    if json is not None:
+        data = _json.dumps(json)
+        headers.setdefault("Content-Type", "application/json")
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    try:
+        conn.request(method, "/" + path, body=data, headers=headers)
+        resp = conn.getresponse()
+        return Response(resp.status, dict((k.lower(), v) for k, v in resp.getheaders()), resp.read())
+    finally:
+        conn.close()
+
+
+def get(url, headers=None, timeout=10):
+    return _request("GET", url, headers=headers, timeout=timeout)
+
+
+def post(url, data=None, json=None, headers=None, timeout=10):
+    return _request("POST", url, data=data, json=json, headers=headers, timeout=timeout)
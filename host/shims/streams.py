@@ -0,0 +1,5 @@
+# Host stand-in for the Zerynth streams module.
+
+
+def serial(*args, **kwargs):
+    pass
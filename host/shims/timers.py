@@ -0,0 +1,10 @@
+# Host stand-in for the Zerynth timers module.
+
+import time
+
+_start = time.monotonic()
+
+
+def now():
+    # milliseconds since the interpreter started, like the device counter since boot
+    return int((time.monotonic() - _start) * 1000)
@@ -0,0 +1,9 @@
+# Host stand-in for the Zerynth wifi module: the link is always up on the loopback interface.
+
+
+def is_linked():
+    return True
+
+
+def link_info():
+    return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1", "00:00:00:00:00:00")
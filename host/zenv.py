@@ -0,0 +1,146 @@
+'''
+Run the library on a host CPython interpreter (3.7 or later), e.g. on a Linux gateway or in a
+simulator, usually with the :mod:`aioserver` engine.
+
+Importing this module installs the Zerynth builtins (thread, sleep, PTUPLE, ...), puts the
+stand-ins of the device modules (streams, timers, wireless, requests) on the import path and
+maps the repository on the ``mozilla.webthing`` package. It must be imported before anything
+of the library::
+
+    import sys
+    sys.path.insert(0, "<repository>/host")
+    import zenv
+    from mozilla.webthing import aioserver, webthing
+
+    webthing.run_server(things, engine=aioserver)
+
+The stdlib socket module is left alone: :func:`install_socket` replaces the one used by the
+webserver (or the forwarder) with :class:`ZSocket`, which adds the Zerynth calling conventions
+to a real socket listening on the loopback interface.
+'''
+
+import builtins
+import os
+import socket
+import sys
+import threading
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHIMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shims")
+
+if SHIMS not in sys.path:
+    sys.path.insert(0, SHIMS)
+
+if "mozilla.webthing" not in sys.modules:
+    _mozilla = types.ModuleType("mozilla")
+    _mozilla.__path__ = []
+    _package = types.ModuleType("mozilla.webthing")
+    _package.__path__ = [ROOT]
+    _mozilla.webthing = _package
+    sys.modules["mozilla"] = _mozilla
+    sys.modules["mozilla.webthing"] = _package
+
+
+def _thread(fn, *args):
+    t = threading.Thread(target=fn, args=args, daemon=True)
+    t.start()
+    return t
+
+
+def _sleep(ms, *args):
+    time.sleep(ms / 1000.0)
+
+
+builtins.thread = _thread
+builtins.sleep = _sleep
+builtins.PTUPLE = tuple
+builtins.PLIST = list
+builtins.PDICT = dict
+builtins.LED0 = 0
+builtins.pinToggle = lambda pin: None
+
+
+class ZSocket():
+    '''
+.. class:: ZSocket(sock=None)
+
+    A stdlib socket with the Zerynth API: timeouts in milliseconds, ``recv_into`` with an
+    offset and ``bind`` taking only a port. Client sockets ``connect`` as usual. Binding port 80 listens on :data:`PORT` of the
+    loopback interface instead; the port actually bound is stored in :data:`bound_port`.
+    '''
+
+    def __init__(self, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock = sock
+
+    def bind(self, port):
+        global bound_port
+        if port == 80:
+            port = PORT
+        self.sock.bind(("127.0.0.1", port))
+        bound_port = self.sock.getsockname()[1]
+
+    def connect(self, address):
+        self.sock.connect(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def listen(self, backlog=128):
+        self.sock.listen(backlog)
+        _bound.set()
+
+    def accept(self):
+        sock, address = self.sock.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return ZSocket(sock), address
+
+    def settimeout(self, ms):
+        self.sock.settimeout(None if ms is None else ms / 1000.0)
+
+    def recv_into(self, buf, n, flags=0, ofs=0):
+        return self.sock.recv_into(memoryview(buf)[ofs:ofs + n], n, flags)
+
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+# port listened on in place of port 80; 0 picks a free one
+PORT = 0
+bound_port = None
+_bound = threading.Event()
+
+
+def install_socket(module, port=None):
+    '''
+.. function:: install_socket(module, port=None)
+
+    Make the ``socket`` global of *module* (the webserver or the forwarder) create :class:`ZSocket`
+    instances. When given, *port* is listened on instead of port 80.
+    '''
+    global PORT
+    if port is not None:
+        PORT = port
+    module.socket = types.SimpleNamespace(socket=ZSocket)
+
+
+def wait_bound(timeout=5):
+    '''
+.. function:: wait_bound(timeout=5)
+
+    Wait for the server to listen on its socket and return the port.
+    '''
+    if not _bound.wait(timeout):
+        raise RuntimeError("server did not start")
+    return bound_port
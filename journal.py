@@ -0,0 +1,336 @@
+'''
+Append-only journal keeping the state of Things across reboots.
+'''
+
+import os
+import json
+import threading
+import timers
+
+# longest sleep, in milliseconds, of the thread writing the journal
+JOURNAL_TICK = 100
+
+
+class FileBackend():
+    '''
+====
+FileBackend class
+====
+
+.. class:: FileBackend(path)
+
+    Store a journal in the file *path* of a mounted filesystem. Any object with the same three
+    methods can be given to :class:`Journal` instead, e.g. for keeping the journal in a flash
+    partition without a filesystem.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        '''
+.. method:: read()
+
+    Return the content of the journal as bytes, empty if there is none yet. Called before
+    anything is appended: a replacement left aside by an interrupted :meth:`replace` is
+    renamed into place first, so that appends extend it.
+        '''
+        try:
+            f = open(self.path, "rb")
+        except Exception:
+            # only the new content remains if replace() was interrupted before its rename
+            try:
+                os.rename(self.path + ".new", self.path)
+                f = open(self.path, "rb")
+            except Exception:
+                return b""
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def append(self, data):
+        '''
+.. method:: append(data)
+
+    Add the bytes *data* at the end of the journal.
+        '''
+        f = open(self.path, "ab")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+    def replace(self, data):
+        '''
+.. method:: replace(data)
+
+    Replace the whole journal with the bytes *data*. The new content is written aside and
+    renamed over the old one, so that an interruption leaves one of the two complete.
+        '''
+        tmp = self.path + ".new"
+        f = open(tmp, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        try:
+            os.rename(tmp, self.path)
+        except Exception:
+            # some filesystems do not rename over an existing file
+            os.remove(self.path)
+            os.rename(tmp, self.path)
+
+
+class Journal():
+    '''
+====
+Journal class
+====
+
+.. class:: Journal(backend, flush_interval=2000, flush_size=1024, compact_size=16384)
+
+    Keep the last value written to every property, the history of every event and the action
+    requests of Things across reboots. A Thing created with ``journal=`` logs every change as a
+    JSON line, ``[<thing id>, <kind>, <key>, <value>]``; lines are buffered and appended to *backend*
+    (e.g. a :class:`FileBackend`) by a background thread, and replayed when the Thing is created
+    again.
+
+    * *backend* stores the journal, see :class:`FileBackend` for the methods it needs.
+    * *flush_interval* is the number of milliseconds a change may wait in memory before it is written.
+    * *flush_size* is the number of buffered bytes that triggers writing without waiting.
+    * *compact_size* is the size in bytes above which the journal is rewritten with only the current
+        state, once it has grown to at least twice that state.
+
+    Changes of the same property or action request that are still buffered replace each other, so
+    that a property written many times between two flushes costs a single line. Changes made less
+    than *flush_interval* milliseconds before a reset are lost, unless :meth:`flush` is called first.
+    The counters ``logged``, ``coalesced``, ``writes``, ``bytes_logged``, ``bytes_written`` and
+    ``compactions`` report the changes logged and replaced while buffered, the writes to *backend*, the
+    bytes of the logged changes and of the writes, and the rewrites of the journal.
+    '''
+
+    def __init__(self, backend, flush_interval=2000, flush_size=1024, compact_size=16384):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.compact_size = compact_size
+
+        # (key, line, keep) waiting to be written, and index in it of the keys that can be replaced
+        self._pending = []
+        self._replaceable = {}
+        self._pending_size = 0
+        # time of the oldest buffered change
+        self._since = None
+        # last lines of every key, i.e. what a compacted journal contains, and their size
+        self._state = None
+        self._live = 0
+        # size of the journal on the backend, and whether it ends with a line cut by a reset
+        self._size = 0
+        self._torn = False
+        # restored values of each Thing, until the Thing is created
+        self._restored = {}
+        self._lock = threading.Lock()
+        # serializes the writes to the backend
+        self._write_lock = threading.Lock()
+        self._wake = threading.Semaphore(0)
+        self._running = False
+
+        self.logged = 0
+        self.coalesced = 0
+        self.writes = 0
+        self.bytes_logged = 0
+        self.bytes_written = 0
+        self.compactions = 0
+
+    def start(self):
+        '''
+.. method:: start()
+
+    Start the thread writing the journal.
+        '''
+        if not self._running:
+            self._running = True
+            thread(self._run)
+
+    def restore(self, thing_id):
+        '''
+.. method:: restore(thing_id)
+
+    Return the state of the Thing *thing_id* found in the journal, as a dict with the keys ``"p"``
+    (property id -> last value written), ``"e"`` (event id -> list of ``[timestamp, data]``, oldest
+    first) and ``"a"`` (action request id -> ``[action id, request, finished]``). The journal is
+    read the first time this method is called.
+        '''
+        self._lock.acquire()
+        try:
+            if self._state is None:
+                self._load()
+            return self._restored.pop(thing_id, {"p": {}, "e": {}, "a": {}})
+        finally:
+            self._lock.release()
+
+    def log(self, thing_id, kind, key, value, keep=1):
+        '''
+.. method:: log(thing_id, kind, key, value, keep=1)
+
+    Buffer a change for writing: *kind* is ``"p"``, ``"e"`` or ``"a"`` as in :meth:`restore`, and
+    only the last *keep* changes of the same *key* survive a compaction. With *keep* 0 the key is
+    forgotten. Called by Things; never blocks on the backend. Values that cannot be encoded as JSON
+    are not saved.
+        '''
+        try:
+            line = json.dumps([thing_id, kind, key, value]) + "\n"
+        except Exception as e:
+            print("Error journaling %s" % key)
+            print(e)
+            return
+        # one string per key of every Thing, whatever the type of key
+        ref = "%s\n%s\n%s" % (thing_id, kind, key)
+        self._lock.acquire()
+        try:
+            self.logged += 1
+            self.bytes_logged += len(line)
+            i = -1
+            if keep <= 1:
+                i = self._replaceable.get(ref, -1)
+            if i >= 0:
+                self._pending_size += len(line) - len(self._pending[i][1])
+                self._pending[i] = (ref, line, keep)
+                self.coalesced += 1
+            else:
+                if keep <= 1:
+                    self._replaceable[ref] = len(self._pending)
+                self._pending.append((ref, line, keep))
+                self._pending_size += len(line)
+            first = self._since is None
+            if first:
+                self._since = timers.now()
+            wake = first or (self._pending_size >= self.flush_size and self._pending_size - len(line) < self.flush_size)
+        finally:
+            self._lock.release()
+        if wake:
+            self._wake.release()
+
+    def flush(self):
+        '''
+.. method:: flush()
+
+    Write the buffered changes now, e.g. before resetting the device.
+        '''
+        self._write_lock.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                if self._state is None:
+                    self._load()
+                pending = self._pending
+                self._pending = []
+                self._replaceable = {}
+                self._pending_size = 0
+                self._since = None
+            finally:
+                self._lock.release()
+            if not pending:
+                return
+            data = "".join([entry[1] for entry in pending]).encode("utf-8")
+            if self._torn:
+                # end the cut line, so that the first new one is not lost with it
+                data = b"\n" + data
+                self._torn = False
+            self.backend.append(data)
+            self.writes += 1
+            self.bytes_written += len(data)
+            self._size += len(data)
+            for entry in pending:
+                self._apply(entry[0], entry[1], entry[2])
+            if self._size >= self.compact_size and self._size >= 2 * self._live:
+                self._compact()
+        except Exception as e:
+            print("Error while writing the journal")
+            print(e)
+        finally:
+            self._write_lock.release()
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            since = self._since
+            size = self._pending_size
+            self._lock.release()
+            if since is None:
+                self._wake.acquire()
+                continue
+            left = self.flush_interval - (timers.now() - since)
+            if left > 0 and size < self.flush_size:
+                # checked again every tick, in case the buffer fills up meanwhile
+                sleep(min(left, JOURNAL_TICK))
+                continue
+            self.flush()
+
+    def _apply(self, ref, line, keep):
+        # Update the compacted state with a line written to the backend.
+        lines = self._state.get(ref)
+        if lines is not None:
+            for old in lines:
+                self._live -= len(old)
+        if keep <= 0:
+            if lines is not None:
+                del self._state[ref]
+            return
+        if lines is None or keep == 1:
+            lines = [line]
+            self._state[ref] = lines
+        else:
+            lines.append(line)
+            if len(lines) > keep:
+                del lines[:len(lines) - keep]
+        for old in lines:
+            self._live += len(old)
+
+    def _compact(self):
+        data = []
+        for ref in self._state:
+            data.extend(self._state[ref])
+        data = "".join(data).encode("utf-8")
+        self.backend.replace(data)
+        self.writes += 1
+        self.bytes_written += len(data)
+        self._size = len(data)
+        self._torn = False
+        self.compactions += 1
+
+    def _load(self):
+        # Read the journal into the compacted state and the values to restore. The caller
+        # holds _lock.
+        self._state = {}
+        data = self.backend.read()
+        self._size = len(data)
+        self._torn = len(data) > 0 and data[-1] != 10
+        for line in data.decode("utf-8").split("\n"):
+            if not line:
+                continue
+            try:
+                thing_id, kind, key, value = json.loads(line)
+                restored = self._restored.get(thing_id)
+                if restored is None:
+                    restored = {"p": {}, "e": {}, "a": {}}
+                    self._restored[thing_id] = restored
+                items = restored[kind]
+            except Exception:
+                # a line cut by a reset while it was being written
+                continue
+            line = line + "\n"
+            ref = "%s\n%s\n%s" % (thing_id, kind, key)
+            if kind == "e":
+                if key not in items:
+                    items[key] = []
+                items[key].append(value)
+                # events keep the history they were written with: the Thing trims it
+                self._apply(ref, line, 1 << 30)
+            elif value is None and kind == "a":
+                items.pop(key, None)
+                self._apply(ref, line, 0)
+            else:
+                items[key] = value
+                self._apply(ref, line, 1)
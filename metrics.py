@@ -0,0 +1,133 @@
+'''
+Request metrics of the webserver, exposed in the Prometheus text format.
+'''
+
+import threading
+
+# upper bounds, in milliseconds, of the buckets of the request duration histogram
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# indexes of the fields of a route record
+_ROUTE = 0
+_METHOD = 1
+_CODES = 2
+_PARSE = 3
+_HANDLER = 4
+_WRITE = 5
+_BYTES_IN = 6
+_BYTES_OUT = 7
+_DURATIONS = 8
+
+
+class Metrics():
+    '''
+====
+Metrics class
+====
+
+.. class:: Metrics()
+
+    Counters and request duration histograms kept per route template and method.
+    Memory grows with the number of registered routes only: requests not matching any route are
+    all counted under the route ``"unmatched"``, and methods without a handler under ``"other"``.
+    '''
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, method, code, parse_ms, handler_ms, write_ms, bytes_in, bytes_out):
+        '''
+.. method:: record(route, method, code, parse_ms, handler_ms, write_ms, bytes_in, bytes_out)
+
+    Account a served request.
+        '''
+        key = method + " " + route
+        self._lock.acquire()
+        try:
+            rec = self._records.get(key)
+            if rec is None:
+                rec = [route, method, {}, 0, 0, 0, 0, 0, [0] * (len(BUCKETS) + 1)]
+                self._records[key] = rec
+            codes = rec[_CODES]
+            codes[code] = codes.get(code, 0) + 1
+            rec[_PARSE] += parse_ms
+            rec[_HANDLER] += handler_ms
+            rec[_WRITE] += write_ms
+            rec[_BYTES_IN] += bytes_in
+            rec[_BYTES_OUT] += bytes_out
+            duration = parse_ms + handler_ms + write_ms
+            i = 0
+            while i < len(BUCKETS) and duration > BUCKETS[i]:
+                i += 1
+            rec[_DURATIONS][i] += 1
+        finally:
+            self._lock.release()
+
+    def render(self, route_count):
+        '''
+.. method:: render(route_count)
+
+    Return all metrics in the Prometheus text exposition format. *route_count* is reported
+    as the current size of the route table.
+        '''
+        self._lock.acquire()
+        try:
+            records = []
+            for key in self._records:
+                rec = self._records[key]
+                records.append([rec[_ROUTE], rec[_METHOD], dict(rec[_CODES]), rec[_PARSE], rec[_HANDLER],
+                                rec[_WRITE], rec[_BYTES_IN], rec[_BYTES_OUT], list(rec[_DURATIONS])])
+        finally:
+            self._lock.release()
+
+        lines = [
+            "# HELP webthing_routes Number of registered routes.",
+            "# TYPE webthing_routes gauge",
+            "webthing_routes %d" % route_count,
+            "# HELP webthing_requests_total Requests served, by status code.",
+            "# TYPE webthing_requests_total counter",
+        ]
+        for rec in records:
+            for code in rec[_CODES]:
+                lines.append('webthing_requests_total{%s,code="%s"} %d' % (_labels(rec), code, rec[_CODES][code]))
+        _add_counter(lines, records, "webthing_parse_seconds_total", "Time spent parsing requests.", _PARSE, True)
+        _add_counter(lines, records, "webthing_handler_seconds_total", "Time spent in handlers.", _HANDLER, True)
+        _add_counter(lines, records, "webthing_write_seconds_total", "Time spent writing responses.", _WRITE, True)
+        _add_counter(lines, records, "webthing_received_bytes_total", "Bytes received.", _BYTES_IN, False)
+        _add_counter(lines, records, "webthing_sent_bytes_total", "Bytes sent.", _BYTES_OUT, False)
+
+        lines.append("# HELP webthing_request_duration_seconds Time from request parsing to response written.")
+        lines.append("# TYPE webthing_request_duration_seconds histogram")
+        for rec in records:
+            labels = _labels(rec)
+            total = 0
+            for i in range(len(BUCKETS)):
+                total += rec[_DURATIONS][i]
+                lines.append('webthing_request_duration_seconds_bucket{%s,le="%s"} %d'
+                             % (labels, _seconds(BUCKETS[i]), total))
+            total += rec[_DURATIONS][len(BUCKETS)]
+            lines.append('webthing_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, total))
+            lines.append("webthing_request_duration_seconds_sum{%s} %s"
+                         % (labels, _seconds(rec[_PARSE] + rec[_HANDLER] + rec[_WRITE])))
+            lines.append("webthing_request_duration_seconds_count{%s} %d" % (labels, total))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def _add_counter(lines, records, name, help_text, field, seconds):
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s counter" % name)
+    for rec in records:
+        if seconds:
+            lines.append("%s{%s} %s" % (name, _labels(rec), _seconds(rec[field])))
+        else:
+            lines.append("%s{%s} %d" % (name, _labels(rec), rec[field]))
+
+
+def _labels(rec):
+    return 'route="%s",method="%s"' % (rec[_ROUTE].replace("\\", "\\\\").replace('"', '\\"'), rec[_METHOD])
+
+
+def _seconds(ms):
+    return "%d.%03d" % (ms // 1000, ms % 1000)
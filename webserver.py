@@ -1,27 +1,133 @@
-import streams
 import socket
 import json
+import threading
+import timers
+from mozilla.webthing import websocket
+from mozilla.webthing import metrics
+from mozilla.webthing import cbor
 
-# we'll store here available API routes and methods
-_routes = {}
+# Routes live in an immutable snapshot (exact routes, parameterised routes, dispatchers):
+# * exact routes are a dict path -> handlers;
+# * parameterised routes (e.g. "/thing/actions/{action}/{request_id}") are a prefix tree of path
+#     segments, every node being a tuple (children, parameter child, handlers);
+# * dispatchers are a dict prefix -> (func, args), see register_dispatcher();
+# where handlers are dicts method -> (func, args, route template).
+# Writers serialize on _routes_lock, build a new snapshot sharing every part they do not change
+# and publish it with a single assignment, so that requests are served without locking and always
+# see a complete table.
+_EMPTY_NODE = ({}, None, None)
+_registry = ({}, _EMPTY_NODE, {})
+_routes_lock = threading.Lock()
+
+# request metrics, collected only after enable_metrics() has been called
+_metrics = None
+
+# number of open connections, see MAX_CONNECTIONS
+_connections = 0
+_connections_lock = threading.Lock()
+
+# request headers made available to the request handling code, all other headers are skipped
+_KEPT_HEADERS = ("connection", "content-type", "accept", "if-none-match", "upgrade", "sec-websocket-key")
+# request bodies are parsed only for these methods, and skipped for the others
+_BODY_METHODS = ("post", "put", "patch")
+
+# Request limits: the request line and every header line must fit in REQUEST_BUFFER_SIZE bytes,
+# at most MAX_HEADERS header lines and MAX_BODY_SIZE bytes of body are accepted.
+REQUEST_BUFFER_SIZE = 512
+MAX_HEADERS = 32
+MAX_BODY_SIZE = 4096
+
+# Persistent connections: a connection is closed after KEEPALIVE_TIMEOUT milliseconds
+# without a new request, or after MAX_KEEPALIVE_REQUESTS requests have been served on it.
+KEEPALIVE_TIMEOUT = 5000
+# once its first bytes have arrived a request must be received within READ_TIMEOUT milliseconds,
+# or it is answered with 408 Request Timeout; a response that cannot be written within
+# WRITE_TIMEOUT milliseconds closes the connection
+READ_TIMEOUT = 3000
+WRITE_TIMEOUT = 5000
+# without workers the accepting thread serves every connection itself: it waits at most
+# SERIAL_WAIT_TIMEOUT milliseconds for the first bytes of a request, so that a client that
+# connects and stays silent holds up the others no longer than that
+SERIAL_WAIT_TIMEOUT = 500
+# an idle WebSocket is pinged after WEBSOCKET_PING_INTERVAL milliseconds, and closed if
+# nothing is received in the same amount of time; a WebSocket whose client does not take a
+# message within WEBSOCKET_WRITE_TIMEOUT milliseconds is closed, so that a slow client does
+# not hold up the updates pushed to the others
+WEBSOCKET_PING_INTERVAL = 30000
+WEBSOCKET_WRITE_TIMEOUT = 1000
+MAX_KEEPALIVE_REQUESTS = 100
+
+# Admission control: at most MAX_CONNECTIONS connections (WebSockets included) are open at the
+# same time. Further connections, and connections finding the queue of the workers full, are
+# answered right away with 503 Service Unavailable, asking the client to retry after
+# RETRY_AFTER seconds.
+MAX_CONNECTIONS = 16
+RETRY_AFTER = 1
+
+# number of threads serving connections when webthing.run_server() is not given workers: one
+# for a client keeping its connection open, e.g. a gateway polling the properties, and one for
+# the others
+DEFAULT_WORKERS = 2
+
+# size in bytes of the buffer every connection uses for assembling responses
+RESPONSE_BUFFER_SIZE = 512
+# bytes reserved at the beginning of that buffer for the head of streamed responses
+_HEAD_ROOM = 128
+_LAST_CHUNK = b"\r\n0\r\n\r\n"
+_HEX_DIGITS = "0123456789abcdefABCDEF"
 
 
 def register_handler(path, method, func, args=()):
     # Register a new available path in the webserver.
 
-    # * *path* is part of URL, e.g. "/my-path"
+    # * *path* is part of URL, e.g. "/my-path". A segment enclosed in braces, e.g. "/my-path/{item}",
+    #     matches any value; matched values are appended to *args* in the order they appear in the path.
     # * *method* is the HTTP method which will be used for this path. E.g. GET, PUT, POST, ....
     # * *func* is a function or method which will be called when a request to this endpoint is received.
     #     This function will receive a payload as argument, and must return a dictionary to be sent as  JSON result for the request.
     #     Instead of returning a dictionary it is possible to return a tuple (status code, name, data) for
     #     specifying the HTTP return code. E.g. (404, 'Not Found', {}).
+    #     A handler registered with the "websocket" method is called in its own thread when a client asks
+    #     to upgrade a GET request for *path* to a WebSocket; it receives a websocket.WebSocket instead of
+    #     the payload and owns the connection until it returns.
     # * *args* is a tuple of additional arguments which we'll be passed to `func`. Please note that the request payload
-    #     will always be the last argument.
-    global _routes
-    if path not in _routes:
-        _routes[path] = {}
-    method = method.lower()
-    _routes[path][method] = (func, args)
+    #     will always be the last argument. For requests without a body the payload is a dict of the query string
+    #     parameters, or None if there is no query string.
+    #     Request bodies can be JSON or CBOR (Content-Type: application/cbor), and returned data is sent as CBOR
+    #     to clients preferring it in their Accept header, so handlers never deal with the format.
+    register_handlers(((path, method, func, args), ))
+
+
+def register_handlers(entries):
+    # Register several handlers at once. The route table is copied once for all of them, which
+    # is much cheaper than calling register_handler() for each one when there are many.
+
+    # * *entries* is a sequence of tuples (path, method, func, args), as the arguments of register_handler().
+    global _registry
+    _routes_lock.acquire()
+    try:
+        routes, templates, dispatchers = _registry
+        copied = False
+        for entry in entries:
+            path = entry[0]
+            method = entry[1].lower()
+            handler = (entry[2], entry[3], path)
+            if "{" in path:
+                templates = _tree_set(templates, path.split("/"), 1, method, handler)
+            else:
+                if not copied:
+                    routes = dict(routes)
+                    copied = True
+                handlers = routes.get(path)
+                if handlers is None:
+                    handlers = {}
+                else:
+                    handlers = dict(handlers)
+                handlers[method] = handler
+                routes[path] = handlers
+        _registry = (routes, templates, dispatchers)
+    finally:
+        _routes_lock.release()
 
 
 def remove_handler(path, method):
@@ -29,89 +135,1029 @@ def remove_handler(path, method):
 
     # * *path* is part of URL, e.g. "/my-path"
     # * *method* is the HTTP method which will be used for this path. E.g. GET, PUT, POST, ....
-    global _routes
-    if path in _routes:
-        del _routes[path][method]
+    global _registry
+    method = method.lower()
+    _routes_lock.acquire()
+    try:
+        routes, templates, dispatchers = _registry
+        if "{" in path:
+            node = _template_node(templates, path)
+            if node is None or node[2] is None or method not in node[2]:
+                return
+            templates = _tree_set(templates, path.split("/"), 1, method, None)
+        else:
+            handlers = routes.get(path)
+            if handlers is None or method not in handlers:
+                return
+            routes = dict(routes)
+            handlers = dict(handlers)
+            del handlers[method]
+            if handlers:
+                routes[path] = handlers
+            else:
+                del routes[path]
+        _registry = (routes, templates, dispatchers)
+    finally:
+        _routes_lock.release()
+
+
+def register_dispatcher(prefix, func, args=()):
+    # Hand every request whose path starts with *prefix* (followed by "/" or nothing) to *func*,
+    # which resolves its routes on demand instead of registering each one of them.
+
+    # * *prefix* is part of URL, e.g. "/my-thing". The longest registered prefix of a path wins,
+    #     and only paths not matching any route registered with register_handler are dispatched.
+    # * *func* is called as func(args, rest), where *rest* is what follows the prefix in the path
+    #     (e.g. "/properties/level", or "" for the prefix itself). It must return a tuple (handlers, values)
+    #     where handlers is a dict of method -> (handler, handler args, route template), as built by
+    #     register_handler, and values a tuple appended to the handler args; or (None, None) when
+    #     nothing matches. The handlers dict must not be modified once returned.
+    register_dispatchers(((prefix, func, args), ))
+
+
+def register_dispatchers(entries):
+    # Register several dispatchers at once; *entries* is a sequence of tuples (prefix, func, args).
+    global _registry
+    _routes_lock.acquire()
+    try:
+        routes, templates, dispatchers = _registry
+        dispatchers = dict(dispatchers)
+        for entry in entries:
+            dispatchers[entry[0]] = (entry[1], entry[2])
+        _registry = (routes, templates, dispatchers)
+    finally:
+        _routes_lock.release()
+
 
+def remove_dispatcher(prefix):
+    # Remove the dispatcher registered for *prefix*.
+    global _registry
+    _routes_lock.acquire()
+    try:
+        routes, templates, dispatchers = _registry
+        if prefix in dispatchers:
+            dispatchers = dict(dispatchers)
+            del dispatchers[prefix]
+            _registry = (routes, templates, dispatchers)
+    finally:
+        _routes_lock.release()
 
-def start():
+
+def enable_metrics(path="/metrics"):
+    # Start collecting per-route request metrics and expose them at *path*, in the Prometheus
+    # text format. Requests are counted by route template and method, with their status codes,
+    # parse, handler and write times, bytes received and sent.
+    global _metrics
+    if _metrics is None:
+        _metrics = metrics.Metrics()
+    register_handler(path, "get", _get_metrics)
+
+
+def _get_metrics(static_args, payload):
+    return Serialized(_metrics.render(_route_count()), "text/plain; version=0.0.4", False)
+
+
+def _route_count():
+    routes, templates, dispatchers = _registry
+    count = len(dispatchers)
+    for path in routes:
+        count += len(routes[path])
+    nodes = [templates]
+    while nodes:
+        node = nodes.pop()
+        if node[2] is not None:
+            count += len(node[2])
+        for segment in node[0]:
+            nodes.append(node[0][segment])
+        if node[1] is not None:
+            nodes.append(node[1])
+    return count
+
+
+def _template_node(node, path):
+    # Walk the prefix tree from node along the segments of a parameterised path and return
+    # the node reached, or None.
+    for segment in path.split("/")[1:]:
+        if segment.startswith("{") and segment.endswith("}"):
+            node = node[1]
+        else:
+            node = node[0].get(segment)
+        if node is None:
+            return None
+    return node
+
+
+def _tree_set(node, segments, i, method, handler):
+    # Return a copy of node where the handler of method for the path made of segments[i:] is
+    # handler, or is removed if handler is None. Only the nodes along the path are copied.
+    # When removing, the handler must exist.
+    children, param, handlers = node
+    if i == len(segments):
+        if handlers is None:
+            handlers = {}
+        else:
+            handlers = dict(handlers)
+        if handler is None:
+            del handlers[method]
+            if not handlers:
+                handlers = None
+        else:
+            handlers[method] = handler
+        return (children, param, handlers)
+    segment = segments[i]
+    if segment.startswith("{") and segment.endswith("}"):
+        if param is None:
+            param = _EMPTY_NODE
+        param = _tree_set(param, segments, i + 1, method, handler)
+        if _is_empty(param):
+            param = None
+    else:
+        child = children.get(segment)
+        if child is None:
+            child = _EMPTY_NODE
+        child = _tree_set(child, segments, i + 1, method, handler)
+        children = dict(children)
+        if _is_empty(child):
+            # drop the branches left without handlers, so that removed routes leave nothing behind
+            del children[segment]
+        else:
+            children[segment] = child
+    return (children, param, handlers)
+
+
+def _is_empty(node):
+    return not node[0] and node[1] is None and node[2] is None
+
+
+def _match(path):
+    # Return a tuple (handlers, values) for the route matching path, where values are the path
+    # segments matched by parameters. Exact paths win over parameterised ones, which win over
+    # dispatchers; (None, None) is returned if no route matches.
+    routes, templates, dispatchers = _registry
+    handlers = routes.get(path)
+    if handlers is not None:
+        return (handlers, ())
+    res = _match_node(templates, path.split("/"), 1, ())
+    if res[0] is not None or not dispatchers:
+        return res
+    i = len(path)
+    while i > 0:
+        entry = dispatchers.get(path[:i])
+        if entry is not None:
+            return entry[0](entry[1], path[i:])
+        i = path.rfind("/", 0, i)
+    return (None, None)
+
+
+def _match_node(node, segments, i, values):
+    if i == len(segments):
+        return (node[2], values)
+    child = node[0].get(segments[i])
+    if child is not None:
+        res = _match_node(child, segments, i + 1, values)
+        if res[0] is not None:
+            return res
+    if node[1] is not None and segments[i]:
+        return _match_node(node[1], segments, i + 1, values + (segments[i],))
+    return (None, None)
+
+
+def start(workers=0, queue_size=4):
+    # Accept connections and serve them.
+
+    # * *workers* is the number of threads serving connections. With the default of 0
+    #     every connection is served by the accepting thread, one at a time, and closed
+    #     after the requests it already carries.
+    # * *queue_size* is the number of accepted connections that may wait for a free
+    #     worker; when the queue is full new connections are refused with 503 Service Unavailable.
     sock = socket.socket()
     sock.bind(80)
     sock.listen()
+    pending = None
+    if workers > 0:
+        pending = _ConnectionQueue(queue_size)
+        for i in range(workers):
+            thread(_worker, pending)
+    # encoded once, so that refusing a connection costs as little as possible
+    page = _encode(_html_page(503, "Service Unavailable"))
+    overload = _encode(
+        "HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Type: text/html\r\n"
+        "Content-Length: %d\r\nConnection: close\r\n\r\n" % (RETRY_AFTER, len(page))
+    ) + page
     while True:
         #sleep(200)
         try:
             client_sock, address = sock.accept()
-            client = streams.SocketStream(client_sock)
-
-            method, path, payload = _parse_request(client)
-            #print(method, path, payload)
-            if path not in _routes:
-                print("Not found: %s" % path)
-                _send_code(client, 404, "Not Found")
-            elif method not in _routes[path]:
-                print("Invalid method %s for path %s" % (method, path))
-                _send_code(client, 405, "Method Not Allowed")
-            else:
-                try:
-                    #print(_routes[path][method])
-                    fun, static_args = _routes[path][method]
-
-                    #print(static_args,payload)
-
-                    result = fun(static_args, payload)
-                    # If result a simple variable we send it as it is,
-                    # otherwise it's a tuple (code, name, response)
-                    if type(result) == PTUPLE:
-                        _send_code(client, result[0], result[1], body=result[2])
-                    else:
-                        _send_response(client, result)
-                except NameError:
-                    _send_code(client, 400, "Bad Request")
-                except Exception as e:
-                    print("Error executing callback")
-                    print(e)
-                    _send_code(client, 500, "Internal Server Error")
+            if not _admit():
+                _refuse(client_sock, overload)
+            elif pending is None:
+                _serve_connection(client_sock, True)
+            elif not pending.put(client_sock):
+                _release()
+                _refuse(client_sock, overload)
+        except Exception as e:
+            print("Error while sending response")
+            print(e)
 
-            client.close()
+
+def _admit():
+    # Count a new connection, unless MAX_CONNECTIONS are already open.
+    global _connections
+    _connections_lock.acquire()
+    try:
+        if _connections >= MAX_CONNECTIONS:
+            return False
+        _connections += 1
+        return True
+    finally:
+        _connections_lock.release()
+
+
+def _release():
+    global _connections
+    _connections_lock.acquire()
+    _connections -= 1
+    _connections_lock.release()
+
+
+def _refuse(client_sock, response):
+    # Answer without reading the request, which might never come.
+    try:
+        client_sock.settimeout(WRITE_TIMEOUT)
+        client_sock.sendall(response)
+    except Exception:
+        pass
+    client_sock.close()
+    if _metrics is not None:
+        _metrics.record("unmatched", "other", 503, 0, 0, 0, 0, len(response))
+
+
+class _ConnectionQueue():
+    # Bounded FIFO of accepted sockets shared by the accept loop and the workers.
+
+    def __init__(self, size):
+        self._items = []
+        self._size = size
+        self._lock = threading.Lock()
+        self._used = threading.Semaphore(0)
+
+    def put(self, item):
+        # Return False, without waiting, if the queue is full.
+        self._lock.acquire()
+        try:
+            if len(self._items) >= self._size:
+                return False
+            self._items.append(item)
+        finally:
+            self._lock.release()
+        self._used.release()
+        return True
+
+    def get(self):
+        self._used.acquire()
+        self._lock.acquire()
+        item = self._items.pop(0)
+        self._lock.release()
+        return item
+
+
+def _worker(pending):
+    while True:
+        client_sock = pending.get()
+        try:
+            _serve_connection(client_sock)
         except Exception as e:
             print("Error while sending response")
             print(e)
 
 
-def _parse_request(client):
-    line = client.readline()
-    method, path, _ = line.split(" ")
+def _serve_connection(client_sock, serial=False):
+    # Serve every request sent on a single connection.
+
+    # The connection is kept open as long as the client allows it (HTTP/1.1 default
+    # or "Connection: keep-alive" for HTTP/1.0), no more than KEEPALIVE_TIMEOUT
+    # milliseconds pass between requests and less than MAX_KEEPALIVE_REQUESTS
+    # requests have been served. Pipelined requests are simply read one after
+    # another from the stream, so they are answered in order.
+    # With serial True the connection is served by the accepting thread, which must not wait
+    # on an idle client: the first request must start within SERIAL_WAIT_TIMEOUT, only the
+    # requests already received are served, and the last one is answered with "Connection: close".
+    # The connection must have been counted by _admit().
+    client = _Connection(client_sock)
+    out = _ResponseWriter(client)
+    detached = False
+    try:
+        served = 0
+        while served < MAX_KEEPALIVE_REQUESTS:
+            received = client.received
+            sent = out.sent
+            if serial:
+                client.wait(SERIAL_WAIT_TIMEOUT)
+            else:
+                client.wait(KEEPALIVE_TIMEOUT)
+            try:
+                request = _parse_request(client)
+            except _HttpError as e:
+                # what follows the invalid request cannot be trusted: answer and close
+                _send_code(out, e.code, e.message)
+                if _metrics is not None:
+                    _metrics.record("unmatched", "other", e.code, timers.now() - client.started, 0, 0,
+                                    client.received - received, out.sent - sent)
+                break
+            if request is None:
+                # client closed the connection or went idle
+                break
+            parsed = timers.now()
+            method, path, version, headers, payload = request
+            served += 1
+            keep_alive = _keep_alive(version, headers) and served < MAX_KEEPALIVE_REQUESTS
+            if serial and client.start == client.end:
+                keep_alive = False
+            if (headers.get("upgrade", "").lower() == "websocket"
+                    and _upgrade(client_sock, client, path, headers)):
+                # the connection now belongs to the WebSocket handler thread
+                detached = True
+                break
+            client_sock.settimeout(WRITE_TIMEOUT)
+            # bodies of unknown length can be sent in chunks only to HTTP/1.1 clients
+            out.chunked = version == "HTTP/1.1"
+            out.cbor = _prefers_cbor(headers)
+            route, method, handler_ms = _handle_request(out, method, path, headers, payload, keep_alive)
+            if _metrics is not None:
+                _metrics.record(route, method, out.status, parsed - client.started, handler_ms,
+                                timers.now() - parsed - handler_ms, client.received - received, out.sent - sent)
+            if not keep_alive or out.must_close:
+                break
+    finally:
+        if not detached:
+            client.close()
+            _release()
+
+
+def _upgrade(client_sock, client, path, headers):
+    # Complete the WebSocket handshake if a "websocket" handler is registered for path
+    # and start it in a new thread. Return False if the request has to be served as usual.
+    handlers, values = _match(path)
+    if handlers is None or "websocket" not in handlers or "sec-websocket-key" not in headers:
+        return False
+    fun, static_args, route = handlers["websocket"]
+    if values:
+        static_args = static_args + values
+    client.write(_encode(
+        "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+        "Sec-WebSocket-Accept: %s\r\n\r\n" % websocket.accept_key(headers["sec-websocket-key"])
+    ))
+    # the WebSocket reads without the deadline of the upgrade request
+    client.deadline = None
+    client.timeouts = (WEBSOCKET_PING_INTERVAL, WEBSOCKET_WRITE_TIMEOUT)
+    thread(_run_websocket, fun, static_args, websocket.WebSocket(client))
+    return True
+
+
+def _run_websocket(fun, static_args, ws):
+    try:
+        fun(static_args, ws)
+    except Exception as e:
+        print("Error executing websocket handler")
+        print(e)
+    ws.close()
+    ws.client.close()
+    _release()
+
+
+def _handle_request(out, method, path, headers, payload, keep_alive):
+    # Serve a parsed request and return a tuple (route, method, handler time) for the metrics,
+    # where route is the template of the matched route.
+    handler_ms = 0
+    # look the path up once: the dict found here is never modified afterwards
+    handlers, values = _match(path)
+    if handlers is None:
+        print("Not found: %s" % path)
+        _send_code(out, 404, "Not Found", keep_alive=keep_alive)
+        return ("unmatched", "other", handler_ms)
+    elif method not in handlers:
+        print("Invalid method %s for path %s" % (method, path))
+        _send_code(out, 405, "Method Not Allowed", keep_alive=keep_alive)
+        route = "unmatched"
+        for other in handlers:
+            route = handlers[other][2]
+            break
+        return (route, "other", handler_ms)
+    else:
+        try:
+            #print(handlers[method])
+            fun, static_args, route = handlers[method]
+
+            #print(static_args,payload)
+
+            if values:
+                static_args = static_args + values
+            started = timers.now()
+            result = fun(static_args, payload)
+            handler_ms = timers.now() - started
+            # If result a simple variable we send it as it is,
+            # otherwise it's a tuple (code, name, response)
+            if type(result) == PTUPLE:
+                _send_code(out, result[0], result[1], body=result[2], keep_alive=keep_alive)
+            elif isinstance(result, Serialized):
+                _send_serialized(out, result, headers, keep_alive)
+            else:
+                _send_response(out, result, keep_alive=keep_alive)
+        except NameError:
+            _send_error(out, 400, "Bad Request", keep_alive)
+        except Exception as e:
+            print("Error executing callback")
+            print(e)
+            _send_error(out, 500, "Internal Server Error", keep_alive)
+        return (route, method, handler_ms)
+
+
+def _send_error(out, code, message, keep_alive):
+    # Answer a failed request. The result of the handler may have been failing to encode
+    # while streamed: what was collected of it is dropped, and if its head has already been
+    # sent the connection is closed, since a second status line cannot follow.
+    if out.head is not None:
+        out.pos = 0
+        out.head = None
+        if out.streaming:
+            out.streaming = False
+            out.status = code
+            out.must_close = True
+            return
+    _send_code(out, code, message, keep_alive=keep_alive)
+
+
+def _parse_request(conn):
+    # Read a request from the connection and return a tuple (method, path, version, headers, payload),
+    # where headers is a dict of the _KEPT_HEADERS found in the request, or None if the
+    # connection has been closed or timed out before a new request arrived.
+    # An _HttpError is raised for requests that are malformed or exceed the configured limits.
+    try:
+        line = conn.readline()
+    except _HttpError as e:
+        if e.code == 431:
+            raise _HttpError(414, "URI Too Long")
+        raise
+    except Exception:
+        return None
+    if line is None:
+        return None
+    conn.started = timers.now()
+    if not line:
+        # tolerate an empty line between pipelined requests
+        line = conn.readline()
+        if not line:
+            return None
+
+    method, path, version, query = _parse_request_line(line)
+    data_length = 0
+    headers = {}
+    count = 0
+    while True:
+        line = conn.readline()
+        if line is None:
+            # connection dropped in the middle of the headers
+            raise _HttpError(400, "Bad Request")
+        if not line:
+            break
+        count += 1
+        data_length = _parse_header(line, count, headers, data_length)
+
+    payload = query
+    if data_length:
+        payload = _decode_payload(method, headers, conn.read_exactly(data_length), query)
+
+    return (method, path, version, headers, payload)
+
+
+def _decode_line(data):
+    # Return a request or header line as text. Shared with aioserver.
+    try:
+        return data.decode("utf-8")
+    except UnicodeError:
+        raise _HttpError(400, "Bad Request")
+
+
+def _parse_request_line(line):
+    # Return a tuple (method, path, version, query) for a request line, with the method in lower
+    # case, the query as a dict (or None) and no trailing slash on the path. Shared with aioserver.
+    parts = line.split(" ")
+    if len(parts) != 3 or not parts[1].startswith("/") or not parts[2].startswith("HTTP/"):
+        raise _HttpError(400, "Bad Request")
+    method, path, version = parts
+
+    query = None
+    mark = path.find("?")
+    if mark >= 0:
+        query = _parse_query(path[mark + 1:])
+        path = path[:mark]
 
     if len(path) > 1 and path.endswith("/"):
         path = path[:-1]
+    return (method.lower(), path, version, query)
 
-    data_length = 0
-    while line not in ("\r\n", "\n"):
-        line = client.readline()
-        if line.lower().startswith("content-length:"):
-            data_length = int(line[16:-1])
-            sleep(10)
 
-    data = client.read(data_length)
-    parsed_data = json.loads(data)
+def _parse_header(line, count, headers, data_length):
+    # Check the count-th header line of a request, store it in headers if it is one of the
+    # _KEPT_HEADERS, and return the length of the body, data_length unless the line gives it.
+    # Shared with aioserver.
+    if count > MAX_HEADERS:
+        raise _HttpError(431, "Request Header Fields Too Large")
+    colon = line.find(":")
+    if colon <= 0:
+        raise _HttpError(400, "Bad Request")
+    name = line[:colon].lower()
+    if name == "content-length":
+        try:
+            data_length = int(line[colon + 1:])
+        except ValueError:
+            raise _HttpError(400, "Bad Request")
+        if data_length < 0:
+            raise _HttpError(400, "Bad Request")
+        if data_length > MAX_BODY_SIZE:
+            raise _HttpError(413, "Payload Too Large")
+    elif name == "transfer-encoding":
+        # request bodies must come with a Content-Length
+        raise _HttpError(411, "Length Required")
+    elif name in _KEPT_HEADERS:
+        headers[name] = line[colon + 1:].strip()
+    return data_length
+
+
+def _decode_payload(method, headers, data, query):
+    # Return the payload of a request with the body data: the decoded body for the
+    # _BODY_METHODS, the query otherwise. Shared with aioserver.
+    if method not in _BODY_METHODS:
+        return query
+    content_type = headers.get("content-type", "json")
+    if "cbor" in content_type:
+        decode = cbor.loads
+    elif "json" in content_type:
+        decode = _json_loads
+    else:
+        raise _HttpError(415, "Unsupported Media Type")
+    try:
+        return decode(data)
+    except Exception:
+        raise _HttpError(400, "Bad Request")
+
+
+def _json_loads(data):
+    return json.loads(data.decode("utf-8"))
+
+
+def _prefers_cbor(headers):
+    # Whether the response to a request should be CBOR rather than JSON: the client must list
+    # application/cbor in its Accept header with a quality not lower than the one of JSON (ties
+    # go to the type listed first). Without an Accept header the format of the request is used.
+    accept = headers.get("accept")
+    if accept is None:
+        return "cbor" in headers.get("content-type", "")
+    cbor_q = 0
+    json_q = 0
+    cbor_first = False
+    for item in accept.split(","):
+        params = item.split(";")
+        media = params[0].strip().lower()
+        q = 1
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if media == "application/cbor":
+            if q > cbor_q:
+                cbor_first = cbor_first or json_q == 0
+                cbor_q = q
+        elif "json" in media or media == "*/*" or media == "application/*":
+            json_q = max(json_q, q)
+    return cbor_q > json_q or (cbor_q > 0 and cbor_q == json_q and cbor_first)
+
+
+def _parse_query(query):
+    params = {}
+    for field in query.split("&"):
+        if not field:
+            continue
+        eq = field.find("=")
+        if eq < 0:
+            params[_unquote(field)] = ""
+        else:
+            params[_unquote(field[:eq])] = _unquote(field[eq + 1:])
+    return params
+
+
+def _unquote(text):
+    # Decode the escapes of a query field; escaped bytes are UTF-8, and a "%" not followed by
+    # two hexadecimal digits is kept as it is.
+    text = text.replace("+", " ")
+    if "%" not in text:
+        return text
+    parts = text.split("%")
+    res = bytearray(parts[0].encode("utf-8"))
+    for part in parts[1:]:
+        if len(part) >= 2 and part[0] in _HEX_DIGITS and part[1] in _HEX_DIGITS:
+            res.append(int(part[:2], 16))
+            res.extend(part[2:].encode("utf-8"))
+        else:
+            res.extend(("%" + part).encode("utf-8"))
+    try:
+        return res.decode("utf-8")
+    except UnicodeError:
+        raise _HttpError(400, "Bad Request")
+
 
-    return (method.lower(), path, parsed_data)
+def _keep_alive(version, headers):
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.1":
+        return connection != "close"
+    return connection == "keep-alive"
 
 
-def _send_code(client, code, message, body=None):
-    print("HTTP/1.1 %s %s\r" % (code, message), stream=client)
-    print("Connection: close\r", stream=client)
-    if body:
-        print("Content-Type: text/json\r\n\r", stream=client)
-        print(json.dumps(body), stream=client)
+def _send_code(out, code, message, body=None, keep_alive=False):
+    out.status = code
+    if body is not None:
+        _send_data(out, code, message, body, keep_alive)
+    elif code in _ERROR_PAGES:
+        if keep_alive:
+            out.write(_ERROR_PAGES[code][1])
+        else:
+            out.write(_ERROR_PAGES[code][0])
+        out.flush()
     else:
-        print("Content-Type: text/html\r\n\r", stream=client)
-        print("<html><body><h1>%s %s</h1></body></html>" % (code, message), stream=client)
+        _send(out, code, message, "text/html", _encode(_html_page(code, message)), keep_alive)
+
+
+def _send_response(out, data, keep_alive=False):
+    _send_data(out, 200, "Ok", data, keep_alive)
+
+
+def _send_data(out, code, message, data, keep_alive):
+    if out.cbor:
+        _send_cbor(out, code, message, data, keep_alive)
+    else:
+        _send_json(out, code, message, data, keep_alive)
+
+
+def _send_cbor(out, code, message, data, keep_alive):
+    # streamed like _send_json()
+    out.start_body(code, message, "application/cbor", keep_alive)
+    cbor.encode(data, out.body)
+    out.end_body()
+
+
+def _send_json(out, code, message, data, keep_alive):
+    # The body is encoded piece by piece into the connection buffer: it is sent with a
+    # Content-Length if it fits there, otherwise in chunks, so the whole JSON text never
+    # has to be kept in memory.
+    out.start_body(code, message, "text/json", keep_alive)
+    _write_json(out, data)
+    out.end_body()
+
+
+def _write_json(out, value):
+    if isinstance(value, dict):
+        out.body("{")
+        first = True
+        for key in value:
+            if first:
+                first = False
+            else:
+                out.body(", ")
+            out.body(json.dumps(str(key)))
+            out.body(": ")
+            _write_json(out, value[key])
+        out.body("}")
+    elif isinstance(value, list) or isinstance(value, tuple):
+        out.body("[")
+        first = True
+        for item in value:
+            if first:
+                first = False
+            else:
+                out.body(", ")
+            _write_json(out, item)
+        out.body("]")
+    else:
+        out.body(json.dumps(value))
+
+
+def _send_serialized(out, result, headers, keep_alive):
+    if result.etag is not None and "if-none-match" in headers:
+        for tag in headers["if-none-match"].split(","):
+            tag = tag.strip()
+            if tag == result.etag or tag == "*":
+                _send(out, 304, "Not Modified", None, None, keep_alive, result.etag)
+                return
+    _send(out, 200, "Ok", result.content_type, result.body, keep_alive, result.etag)
+
+
+def _send(out, code, message, content_type, body, keep_alive, etag=None):
+    # A persistent connection needs an exact Content-Length, so that the client
+    # knows where the response ends and the next one begins.
+    out.status = code
+    if body is None:
+        out.write(_encode(_head(code, message, None, None, keep_alive, etag)))
+    else:
+        out.write(_encode(_head(code, message, content_type, len(body), keep_alive, etag)))
+        out.write(body)
+    out.flush()
+
+
+def _head(code, message, content_type, length, keep_alive, etag=None, chunked=False):
+    # Format status line and headers. With no length and chunked False the body, if any,
+    # ends when the connection is closed.
+    head = "HTTP/1.1 %s %s\r\n" % (code, message)
+    if etag is not None:
+        head += "ETag: %s\r\n" % etag
+    if content_type is not None:
+        head += "Content-Type: %s\r\n" % content_type
+    if length is not None:
+        head += "Content-Length: %s\r\n" % length
+    elif chunked:
+        head += "Transfer-Encoding: chunked\r\n"
+    if keep_alive:
+        return head + "Connection: keep-alive\r\n\r\n"
+    return head + "Connection: close\r\n\r\n"
+
+
+def _html_page(code, message):
+    return "<html><body><h1>%s %s</h1></body></html>" % (code, message)
+
+
+def _encode(text):
+    return text.encode("utf-8")
+
+
+# complete responses for the error codes sent by the server itself,
+# as a tuple (response closing the connection, response keeping it alive)
+_ERROR_PAGES = {}
+for _code, _message in ((400, "Bad Request"), (404, "Not Found"), (405, "Method Not Allowed"),
+                        (408, "Request Timeout"), (411, "Length Required"), (413, "Payload Too Large"), (414, "URI Too Long"),
+                        (415, "Unsupported Media Type"), (431, "Request Header Fields Too Large"),
+                        (500, "Internal Server Error")):
+    _page = _encode(_html_page(_code, _message))
+    _ERROR_PAGES[_code] = (
+        _encode(_head(_code, _message, "text/html", len(_page), False)) + _page,
+        _encode(_head(_code, _message, "text/html", len(_page), True)) + _page
+    )
+
+
+class _HttpError(Exception):
+
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+
+class _Connection():
+    # A client socket read through a buffer of REQUEST_BUFFER_SIZE bytes allocated once per
+    # connection. Lines are split inside the buffer, so a line longer than the buffer is refused
+    # instead of growing memory.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = bytearray(REQUEST_BUFFER_SIZE)
+        self.start = 0
+        self.end = 0
+        # bytes received so far and arrival time of the current request, for the metrics
+        self.received = 0
+        self.started = 0
+        # time by which the request being received must be complete, None while waiting for one
+        self.deadline = None
+        # socket timeouts (read, write) of a WebSocket, set before every read and write since
+        # the two directions are used by different threads
+        self.timeouts = None
+
+    def wait(self, timeout):
+        # Get ready to wait up to timeout milliseconds for the next request.
+        self.deadline = None
+        self.sock.settimeout(timeout)
+
+    def _fill(self):
+        # move unread bytes to the front of the buffer and receive more after them;
+        # return the number of bytes received, 0 when the client has closed the connection
+        if self.start > 0:
+            n = self.end - self.start
+            self.buf[0:n] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = n
+        if self.deadline is not None:
+            left = self.deadline - timers.now()
+            if left <= 0:
+                raise _HttpError(408, "Request Timeout")
+            self.sock.settimeout(left)
+        elif self.timeouts is not None:
+            self.sock.settimeout(self.timeouts[0])
+        try:
+            n = self.sock.recv_into(self.buf, len(self.buf) - self.end, 0, self.end)
+        except Exception:
+            if self.deadline is not None:
+                raise _HttpError(408, "Request Timeout")
+            raise
+        if n and self.deadline is None:
+            # the first bytes of a request: the rest must follow within READ_TIMEOUT
+            self.deadline = timers.now() + READ_TIMEOUT
+        self.end += n
+        self.received += n
+        return n
+
+    def readline(self):
+        # Return the next line without its terminator, or None if the connection is closed first.
+        # Raise _HttpError if the line does not fit in the buffer.
+        while True:
+            eol = self.buf.find(b"\n", self.start, self.end)
+            if eol >= 0:
+                stop = eol
+                if stop > self.start and self.buf[stop - 1] == 13:
+                    stop -= 1
+                line = _decode_line(self.buf[self.start:stop])
+                self.start = eol + 1
+                return line
+            if self.end - self.start == len(self.buf):
+                raise _HttpError(431, "Request Header Fields Too Large")
+            if self._fill() == 0:
+                return None
+
+    def read(self, n):
+        # Return up to n bytes, at least one unless the connection has been closed.
+        if self.start == self.end and self._fill() == 0:
+            return b""
+        n = min(n, self.end - self.start)
+        data = bytes(self.buf[self.start:self.start + n])
+        self.start += n
+        return data
+
+    def read_exactly(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.read(n - len(data))
+            if not chunk:
+                raise _HttpError(400, "Bad Request")
+            data.extend(chunk)
+        return data
+
+    def write(self, data):
+        if self.timeouts is not None:
+            self.sock.settimeout(self.timeouts[1])
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class _ResponseWriter():
+    # Collects a response in a buffer allocated once per connection, so that it reaches the
+    # socket with a single write. Data that does not fit in the buffer is written through.
+
+    # Bodies of unknown length are streamed with start_body(), body() and end_body(): they are
+    # collected after _HEAD_ROOM bytes, leaving space for the head (or chunk size) to be placed
+    # right in front of them when the buffer is full or the body is complete.
+
+    def __init__(self, client):
+        self.client = client
+        self.buf = bytearray(RESPONSE_BUFFER_SIZE)
+        self.pos = 0
+        self.chunked = True
+        # True when data is sent as CBOR instead of JSON
+        self.cbor = False
+        self.must_close = False
+        self.head = None
+        self.streaming = False
+        # status code of the last response and bytes sent so far, for the metrics
+        self.status = 0
+        self.sent = 0
+
+    def _write(self, data):
+        self.sent += len(data)
+        self.client.write(data)
+
+    def write(self, data):
+        n = len(data)
+        if self.pos + n > len(self.buf):
+            self.flush()
+            if n > len(self.buf):
+                # written as it is, as copying it behind the head would cost its size again
+                self._write(data)
+                return
+        self.buf[self.pos:self.pos + n] = data
+        self.pos += n
+
+    def flush(self):
+        if self.pos:
+            self._write(self.buf[:self.pos])
+            self.pos = 0
+
+    def start_body(self, code, message, content_type, keep_alive):
+        self.flush()
+        self.status = code
+        self.head = (code, message, content_type, keep_alive)
+        self.streaming = False
+        self.pos = _HEAD_ROOM
+
+    def body(self, data):
+        if isinstance(data, str):
+            data = _encode(data)
+        n = len(data)
+        room = len(self.buf) - len(_LAST_CHUNK)
+        start = 0
+        while start < n:
+            if self.pos == room:
+                self._send_body(False)
+            m = min(n - start, room - self.pos)
+            self.buf[self.pos:self.pos + m] = data[start:start + m]
+            self.pos += m
+            start += m
+
+    def end_body(self):
+        if self.streaming:
+            self._send_body(True)
+        else:
+            code, message, content_type, keep_alive = self.head
+            self._emit(_head(code, message, content_type, self.pos - _HEAD_ROOM, keep_alive), b"")
+        self.pos = 0
+        self.head = None
+
+    def _send_body(self, last):
+        code, message, content_type, keep_alive = self.head
+        size = self.pos - _HEAD_ROOM
+        prefix = ""
+        if not self.streaming:
+            self.streaming = True
+            if not self.chunked:
+                # without chunks the end of the body is marked by closing the connection
+                self.must_close = True
+            prefix = _head(code, message, content_type, None, keep_alive and self.chunked,
+                           chunked=self.chunked)
+        if not self.chunked:
+            self._emit(prefix, b"")
+        elif last and size == 0:
+            self._emit(prefix, b"0\r\n\r\n")
+        elif last:
+            self._emit(prefix + "%x\r\n" % size, _LAST_CHUNK)
+        else:
+            self._emit(prefix + "%x\r\n" % size, b"\r\n")
+
+    def _emit(self, prefix, suffix):
+        # write prefix, the collected body and suffix with a single write when possible
+        prefix = _encode(prefix)
+        start = _HEAD_ROOM - len(prefix)
+        if start < 0:
+            self._write(prefix)
+            start = _HEAD_ROOM
+        else:
+            self.buf[start:_HEAD_ROOM] = prefix
+        self.buf[self.pos:self.pos + len(suffix)] = suffix
+        self._write(self.buf[start:self.pos + len(suffix)])
+        self.pos = _HEAD_ROOM
+
+
+class Serialized():
+    # A response body already serialised to JSON, or to *content_type*, to be sent as it is.
+
+    # Handlers returning data that rarely changes can keep an instance around and return it
+    # instead of a dictionary. *body* is text, or bytes already encoded in UTF-8. Unless *etag*
+    # is False, responses carry an ETag computed from the body, and requests with a matching
+    # If-None-Match header are answered with 304 Not Modified and no body.
+
+    def __init__(self, body, content_type="text/json", etag=True):
+        if isinstance(body, str):
+            body = _encode(body)
+        if etag:
+            self.etag = _etag(body)
+        else:
+            self.etag = None
+        self.content_type = content_type
+        self.body = body
+
+
+def serialize(value, etag=True):
+    # Return a Serialized JSON body for value. The JSON text is encoded piece by piece
+    # straight into the bytes kept, so that it never exists as text next to its encoding.
+    out = _BodyBuffer()
+    _write_json(out, value)
+    return Serialized(out.data, "text/json", etag)
+
+
+class _BodyBuffer():
+    # Collects the body written by _write_json(), as _ResponseWriter.body() would send it.
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def body(self, data):
+        if isinstance(data, str):
+            data = _encode(data)
+        self.data.extend(data)
 
 
-def _send_response(client, data):
-    print("HTTP/1.1 200 Ok\r", stream=client)
-    print("Content-Type: text/json\r", stream=client)
-    print("Connection: close\r\n\r", stream=client)
-    print(json.dumps(data), stream=client)
+def _etag(body):
+    # Adler-32 checksum of the bytes of body: cheap to compute and small enough for the VM integers
+    a = 1
+    b = 0
+    for c in body:
+        a = (a + c) % 65521
+        b = (b + a) % 65521
+    return '"%04x%04x"' % (b, a)
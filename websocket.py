@@ -0,0 +1,229 @@
+'''
+WebSocket connections (RFC 6455) upgraded from the webserver.
+'''
+
+import threading
+
+_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_B64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+_TEXT = 0x1
+_CLOSE = 0x8
+_PING = 0x9
+_PONG = 0xA
+
+# messages longer than this many bytes are refused and the connection is closed
+MAX_MESSAGE_SIZE = 4096
+
+
+def accept_key(key):
+    # Return the value of the Sec-WebSocket-Accept header answering a Sec-WebSocket-Key.
+    return _base64(_sha1((key.strip() + _GUID).encode("utf-8")))
+
+
+class WebSocket():
+    '''
+====
+WebSocket class
+====
+
+.. class:: WebSocket(client)
+
+    A server side WebSocket connection over the stream *client*, whose opening handshake
+    has already been completed. Messages can be sent from any thread while another one
+    is waiting in :meth:`receive`.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.closed = False
+        self._ping_sent = False
+        self._lock = threading.Lock()
+
+    def send(self, text):
+        '''
+.. method:: send(text)
+
+    Send *text* in a single text frame. If the client does not take it in time an exception is
+    raised and the connection is considered lost.
+        '''
+        self._send_frame(_TEXT, text.encode("utf-8"))
+
+    def receive(self):
+        '''
+.. method:: receive()
+
+    Wait for the next text message and return it, or return None when the connection has
+    been closed. If the socket read times out a ping is sent to the client; the connection is
+    considered lost when a second timeout expires without any frame being received.
+        '''
+        message = bytearray()
+        while not self.closed:
+            try:
+                head = self._read(2)
+            except Exception:
+                if self._ping_sent:
+                    self.close()
+                    return None
+                self._ping_sent = True
+                self._send_frame(_PING, b"")
+                continue
+            self._ping_sent = False
+
+            opcode = head[0] & 0x0f
+            length = head[1] & 0x7f
+            if length == 126:
+                ext = self._read(2)
+                length = (ext[0] << 8) | ext[1]
+            elif length == 127:
+                ext = self._read(8)
+                length = 0
+                for b in ext:
+                    length = (length << 8) | b
+            if length + len(message) > MAX_MESSAGE_SIZE:
+                self.close(1009)
+                return None
+            mask = None
+            if head[1] & 0x80:
+                mask = self._read(4)
+            data = bytearray(self._read(length))
+            if mask is not None:
+                for i in range(length):
+                    data[i] ^= mask[i & 3]
+
+            if opcode == _CLOSE:
+                self._send_frame(_CLOSE, data[:2])
+                self.closed = True
+                return None
+            elif opcode == _PING:
+                self._send_frame(_PONG, data)
+            elif opcode == _PONG:
+                pass
+            else:
+                message.extend(data)
+                if head[0] & 0x80:
+                    return message.decode("utf-8")
+        return None
+
+    def close(self, code=1000):
+        '''
+.. method:: close(code=1000)
+
+    Send a close frame with status *code* and stop accepting messages.
+        '''
+        if self.closed:
+            return
+        try:
+            self._send_frame(_CLOSE, bytearray([code >> 8, code & 0xff]))
+        except Exception:
+            pass
+        self.closed = True
+
+    def _send_frame(self, opcode, data):
+        n = len(data)
+        frame = bytearray()
+        frame.append(0x80 | opcode)
+        if n < 126:
+            frame.append(n)
+        elif n < 65536:
+            frame.append(126)
+            frame.append(n >> 8)
+            frame.append(n & 0xff)
+        else:
+            frame.append(127)
+            for shift in (56, 48, 40, 32, 24, 16, 8, 0):
+                frame.append((n >> shift) & 0xff)
+        frame.extend(data)
+        self._lock.acquire()
+        try:
+            self.client.write(frame)
+        except Exception:
+            # part of the frame may have been sent: nothing else can follow it
+            self.closed = True
+            raise
+        finally:
+            self._lock.release()
+
+    def _read(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.client.read(n - len(data))
+            if not chunk:
+                self.closed = True
+                raise IOError
+            data.extend(chunk)
+        return data
+
+
+def _rotl(x, n):
+    return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+
+def _sha1(data):
+    # SHA-1 is only needed once per handshake, a plain implementation is enough.
+    h = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476, 0xC3D2E1F0]
+    bits = len(data) * 8
+    msg = bytearray(data)
+    msg.append(0x80)
+    while len(msg) % 64 != 56:
+        msg.append(0)
+    for shift in (56, 48, 40, 32, 24, 16, 8, 0):
+        msg.append((bits >> shift) & 0xff)
+
+    w = [0] * 80
+    for block in range(0, len(msg), 64):
+        for i in range(16):
+            j = block + i * 4
+            w[i] = (msg[j] << 24) | (msg[j + 1] << 16) | (msg[j + 2] << 8) | msg[j + 3]
+        for i in range(16, 80):
+            w[i] = _rotl(w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16], 1)
+        a, b, c, d, e = h
+        for i in range(80):
+            if i < 20:
+                f = (b & c) | (~b & d)
+                k = 0x5A827999
+            elif i < 40:
+                f = b ^ c ^ d
+                k = 0x6ED9EBA1
+            elif i < 60:
+                f = (b & c) | (b & d) | (c & d)
+                k = 0x8F1BBCDC
+            else:
+                f = b ^ c ^ d
+                k = 0xCA62C1D6
+            t = (_rotl(a, 5) + (f & 0xffffffff) + e + k + w[i]) & 0xffffffff
+            e = d
+            d = c
+            c = _rotl(b, 30)
+            b = a
+            a = t
+        h = [(h[0] + a) & 0xffffffff, (h[1] + b) & 0xffffffff, (h[2] + c) & 0xffffffff,
+             (h[3] + d) & 0xffffffff, (h[4] + e) & 0xffffffff]
+
+    digest = bytearray()
+    for x in h:
+        for shift in (24, 16, 8, 0):
+            digest.append((x >> shift) & 0xff)
+    return digest
+
+
+def _base64(data):
+    res = ""
+    for i in range(0, len(data), 3):
+        chunk = data[i:i + 3]
+        n = len(chunk)
+        v = chunk[0] << 16
+        if n > 1:
+            v |= chunk[1] << 8
+        if n > 2:
+            v |= chunk[2]
+        res += _B64[(v >> 18) & 63] + _B64[(v >> 12) & 63]
+        if n > 1:
+            res += _B64[(v >> 6) & 63]
+        else:
+            res += "="
+        if n > 2:
+            res += _B64[v & 63]
+        else:
+            res += "="
+    return res
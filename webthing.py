@@ -4,9 +4,64 @@ Mozilla WebThing library.
 
 import streams
 from mozilla.webthing import webserver
+from mozilla.webthing import clock as _clock
 from wireless import wifi
 import json
 import requests
+import threading
+import timers
+
+# bumped every time a Thing description changes, so that list_things knows when
+# its cached response is stale
+_descriptions_generation = 0
+_things_description = None
+
+# set by run_server() when the server engine lets getters, setters and action callbacks be
+# coroutine functions: turns what they return into a value, see aioserver.resolve()
+_resolve = None
+
+# longest sleep, in milliseconds, of the thread sampling properties
+SAMPLER_TICK = 100
+
+# indexes of the fields of a property record
+_P_LABEL = 0
+_P_TYPE = 1
+_P_UNIT = 2
+_P_DESCRIPTION = 3
+_P_GETTER = 4
+_P_SETTER = 5
+# cached value, None when every read calls the getter:
+# [value, time of the read or None, max_age, sample_period, stale_while_refresh, refresh requested]
+_P_SAMPLE = 6
+# change filter of the propertyStatus notifications, or None
+_P_FILTER = 7
+
+# indexes of the fields of an action record
+_A_LABEL = 0
+_A_INPUT = 1
+_A_DESCRIPTION = 2
+_A_CALLBACK = 3
+
+# indexes of the fields of an event record
+_E_DESCRIPTION = 0
+# last occurrences of the event, as (timestamp, data) records
+_E_HISTORY = 1
+# change filter of the occurrences, or None
+_E_FILTER = 2
+
+# indexes of the fields of a change filter, deciding which property changes and event
+# occurrences are emitted
+_F_DEADBAND = 0
+_F_MIN_INTERVAL = 1
+_F_COALESCE = 2
+# last emitted value and time of its emission, None until the first one
+_F_LAST = 3
+_F_LAST_TIME = 4
+# (value, item) waiting for the minimum interval to pass, or None
+_F_PENDING = 5
+# number of values dropped, and of values replaced by a later one while pending
+_F_DROPPED = 6
+_F_COALESCED = 7
 
 
 class Thing():
@@ -20,32 +75,43 @@ Thing class
     A Thing is an object exposing some REST API containing properties, actions
     and events.
     '''
-    properties = {}
-    getters = {}
-    setters = {}
-
-    actions = {}
-    action_request = []
-    # making a copy of each action request in seperate lists;
-    # one for the name of the action and one for the unique id
-    action_request_specific = {}
-    action_request_specific_id = {}
-    events = {}
-    # making a list to have each event description
-    event_descr = {}
-    callbacks = {}
-    running = {}
-    _uid = 0
-
-    def __init__(self, thing_id, name, description=None, base_url="/", timestamp_fn=None):
+    __slots__ = (
+        "id", "name", "description", "webserver", "timestamp_fn", "clock", "base_url",
+        "properties", "actions", "events", "action_request", "action_max_age",
+        "_uid", "_action_lock", "_action_queue", "_action_queue_size", "_action_ready",
+        "_action_workers", "_action_workers_started", "_description", "_subscribers",
+        "_sampling", "_event_lock", "_routes", "_forwarder", "_journal", "_restored",
+    )
+
+    def __init__(self, thing_id, name, description=None, base_url="/", timestamp_fn=None,
+                 action_history=16, action_max_age=None, clock=None, action_workers=1, action_queue=8,
+                 forwarder=None, journal=None):
         '''
-.. method:: __init__(thing_id, name, description=None, base_url="/", timestamp_fn=None)
+.. method:: __init__(thing_id, name, description=None, base_url="/", timestamp_fn=None, action_history=16, action_max_age=None, clock=None, action_workers=1, action_queue=8, forwarder=None, journal=None)
 
     * *thing_id* is the unique id for a Thing
     * *name* is pretty name for human interfaces
     * *description* is a human readable description of this Thing
     * *base_url* is the base path, configurable for advanced purposes.
     * *timestamp_fn* is a function to call for retrieving a timestamp string to be used in events generation.
+        It is not called for every event: it synchronises, in a background thread, a :class:`clock.Clock`
+        which then timestamps events without any I/O.
+    * *action_history* is the maximum number of action requests remembered by this Thing. When it is
+        reached the oldest completed or cancelled request is forgotten to make room for the new one; if
+        none is, further requests are refused with 503 Service Unavailable.
+    * *action_max_age* is the number of milliseconds a completed, cancelled or failed action request is
+        remembered for; with None requests are only forgotten to make room for new ones.
+    * *clock* is a :class:`clock.Clock` used for timestamping events, e.g. one shared by several Things.
+        When given, *timestamp_fn* is ignored.
+    * *action_workers* is the number of threads running requested actions, started with the first request.
+    * *action_queue* is the maximum number of action requests waiting for a worker; further requests are
+        refused with 503 Service Unavailable.
+    * *forwarder* is a :class:`forwarder.Forwarder`, possibly shared by several Things, receiving a record
+        for every emitted event and property change. It is started if needed.
+    * *journal* is a :class:`journal.Journal`, possibly shared by several Things, saving the last value
+        written to every property, the event histories and the action requests. What it holds for
+        *thing_id* is restored: action requests now, properties and events when they are added. Requests
+        that were pending or executing when the device stopped are restored as failed.
         '''
         self.id = thing_id
         self.name = name
@@ -56,19 +122,75 @@ Thing class
 
         self.webserver = None
 
-        self.timestamp_fn = timestamp_fn()
+        # one record per property, action and event: see the _P_, _A_ and _E_ indexes
+        self.properties = {}
+        self.actions = {}
+        self.events = {}
+        self._uid = 0
+
+        self.timestamp_fn = timestamp_fn
+        if clock is None:
+            clock = _clock.Clock(timestamp_fn)
+            clock.start()
+        self.clock = clock
         if not base_url.startswith("/"):
             base_url = "/" + base_url
         if not base_url.endswith("/"):
             base_url = base_url + "/"
         self.base_url = base_url
 
+        # every action request is a list [id, action id, payload, callback, finish time],
+        # where finish time is None while the action is pending or executing
+        self.action_request = RingBuffer(action_history)
+        self.action_max_age = action_max_age
+        self._action_lock = threading.Lock()
+        # requests waiting for one of the action workers, started with the first request, so that
+        # Things whose actions are never requested cost no thread
+        self._action_queue = []
+        self._action_queue_size = action_queue
+        self._action_ready = threading.Semaphore(0)
+        self._action_workers = action_workers
+        self._action_workers_started = False
+
+        # serialised description, rebuilt on the first request after a change
+        self._description = None
+
+        # handlers of the routes of this Thing when served by _dispatch(), built on the first request
+        self._routes = None
+
+        # WebSocket connections receiving property, event and action updates
+        self._subscribers = []
+
+        # True once the thread refreshing cached property values has been started
+        self._sampling = False
+
+        # protects the event histories and the change filters
+        self._event_lock = threading.Lock()
+
+        self._forwarder = forwarder
+        if forwarder is not None:
+            forwarder.start()
+
+        # state saved by the journal, and what it held for this Thing until it is restored
+        self._journal = journal
+        self._restored = None
+        if journal is not None:
+            self._restored = journal.restore(thing_id)
+            self._restore_action_requests()
+            journal.start()
+
 
     def _get_uid(self):
         self._uid += 1
         return self._uid
 
 
+    def _invalidate_description(self):
+        global _descriptions_generation
+        self._description = None
+        _descriptions_generation += 1
+
+
     def _set_webserver(self, server):
         '''
         Store a webserver instance for using it later when an action is created.
@@ -76,9 +198,69 @@ Thing class
         self.webserver = server
 
 
-    def add_property(self, prop_id, label, prop_type, getter, setter=None, unit=None, description=None):
+    def _dispatch(self, static_args, rest):
+        # Resolve the part of a request path following the prefix of this Thing, for
+        # webserver.register_dispatcher(). Routes are the same _add_routes() creates.
+        routes = self._routes
+        if routes is None:
+            routes = self._build_routes()
+        segments = rest.split("/")
+        n = len(segments)
+        if n == 1:
+            if rest:
+                return (None, None)
+            return (routes[0], ())
+        for i in range(2, n):
+            if not segments[i]:
+                return (None, None)
+        kind = segments[1]
+        if kind == "properties":
+            if n == 2:
+                return (routes[1], ())
+            if n == 3:
+                prop = self.properties.get(segments[2])
+                if prop is None:
+                    return (None, None)
+                if prop[_P_SETTER] is None:
+                    return (routes[2], (segments[2], ))
+                return (routes[3], (segments[2], ))
+        elif kind == "actions":
+            if n <= 4:
+                return (routes[n + 2], tuple(segments[2:]))
+        elif kind == "events":
+            if n <= 3:
+                return (routes[n + 5], tuple(segments[2:]))
+        return (None, None)
+
+    def _build_routes(self):
+        # handlers dicts in the order _dispatch() indexes them: the Thing, its properties,
+        # a read-only and a writable property, actions, an action, an action request,
+        # events and an event
+        prefix = "%s%s" % (self.base_url, self.id)
+        self._routes = (
+            {"get": (describe_thing, (self, ), prefix), "websocket": (self._serve_websocket, (), prefix)},
+            {"get": (self._get_all_properties, (), prefix + "/properties"),
+             "put": (self._set_properties, (), prefix + "/properties")},
+            {"get": (self._get_property, (), prefix + "/properties/{property}")},
+            {"get": (self._get_property, (), prefix + "/properties/{property}"),
+             "put": (self._set_property, (), prefix + "/properties/{property}")},
+            {"post": (self._dispatch_action, (True, ), prefix + "/actions"),
+             "cancel": (self._dispatch_action, (False, ), prefix + "/actions"),
+             "get": (self._get_all_actions_requests, (False, ), prefix + "/actions")},
+            {"get": (self._get_action_request_specific, (), prefix + "/actions/{action}")},
+            {"get": (self._get_action_request_specific_id, (), prefix + "/actions/{action}/{request_id}"),
+             "delete": (self._cancel_action, (), prefix + "/actions/{action}/{request_id}")},
+            {"get": (self._dispatch_all_event, (False, ), prefix + "/events")},
+            {"get": (self._get_event_specific, (), prefix + "/events/{event}")},
+        )
+        return self._routes
+
+
+    def add_property(self, prop_id, label, prop_type, getter, setter=None, unit=None, description=None,
+                     max_age=None, sample_period=None, stale_while_refresh=False,
+                     deadband=None, min_interval=None, coalesce=False):
         '''
-..  method:: add_property(prop_id, label, prop_type, getter, setter=None, unit=None, description=None)
+..  method:: add_property(prop_id, label, prop_type, getter, setter=None, unit=None, description=None, max_age=None, sample_period=None, stale_while_refresh=False, deadband=None, min_interval=None, coalesce=False)
 
         Add a new property to this thing.
 
@@ -89,24 +271,34 @@ Thing class
     * *setter* is a function that must accept new status as a parameter and set it
     * *unit* is a pretty name for the measure unit of this property
     * *description* is a human readable description of this property
+    * *max_age* is the number of milliseconds a value read from *getter* is served to clients before
+        *getter* is called again; with None every read calls *getter*, unless *sample_period* is given.
+    * *sample_period* is the number of milliseconds between two reads of *getter* done by a background
+        thread; clients are then served the last sampled value.
+    * *stale_while_refresh* when True a value older than *max_age* is still served, while the background
+        thread reads a fresh one, so that clients never wait for a slow *getter*.
+    * *deadband*, *min_interval* and *coalesce* limit the changes of this property pushed to WebSocket
+        clients, as for the occurrences of an event (see :meth:`register_event`). When one of them is given,
+        changes of the value read by the background thread of a sampled property are pushed too.
         '''
-        if description==None:
-            inner_descr = "No description provided"
-        else:
-            inner_descr = description
-        prop = {
-            "label": label,
-            "type": prop_type,
-            "readOnly": setter is None,
-            "description":  inner_descr,
-            "links": [{"href":"%s%s/properties/%s" % (self.base_url, self.id, prop_id)}],
-        }
-        if unit:
-            prop["unit"] = unit
-        self.properties[prop_id] = prop
-        self.getters[prop_id] = getter
-        if setter:
-            self.setters[prop_id] = setter
+        sample = None
+        if max_age is not None or sample_period is not None:
+            sample = [None, None, max_age, sample_period, stale_while_refresh, False]
+        change_filter = _new_filter(deadband, min_interval, coalesce)
+        self.properties[prop_id] = (label, prop_type, unit, description, getter, setter, sample, change_filter)
+        if self._restored is not None and prop_id in self._restored["p"]:
+            value = self._restored["p"].pop(prop_id)
+            if setter is not None:
+                try:
+                    _call(setter, value)
+                except Exception as e:
+                    print("Error restoring property %s" % prop_id)
+                    print(e)
+        if sample is not None and (sample_period is not None or stale_while_refresh):
+            self._start_sampling()
+        if change_filter is not None and coalesce:
+            self._start_sampling()
+        self._invalidate_description()
 
 
     def add_action(self, act_id, label, callback, input_type=None, description=None):
@@ -118,29 +310,44 @@ Thing class
     * *act_id* is a string for identifying uniquely an action
     * *label* is a pretty name for this action
     * *input_type* can be one of ["integer", "number", "boolean"].
-    * *callback* is a function that must accept a parameter of `input_type` and use it
+    * *callback* is a function called as ``callback(True, input)`` by an action worker thread to run a
+        requested action, where *input* is of `input_type`; the action is completed when it returns, and
+        failed if it raises. While it is running, cancelling the request calls ``callback(False, None)``.
     * *description* is a human readable description of this action
         '''
-        action = {
-            "label": label,
-        }
-        action["description"] = description
-        action["input"] = {"type":input_type}
-        self.actions[act_id] = action
-        self.callbacks[act_id] = callback
+        self.actions[act_id] = (label, input_type, description, callback)
+        self._invalidate_description()
 
-    def register_event(self, evt_id, description):
+    def register_event(self, evt_id, description, history=8, deadband=None, min_interval=None, coalesce=False):
         '''
-..  method:: register_event(evt_id, description)
+..  method:: register_event(evt_id, description, history=8, deadband=None, min_interval=None, coalesce=False)
 
     Register a new event type to this Thing.
 
     * *evt_id* is a string for identifying uniquely this event type.
     * *description* is a human readable description for this event.
+    * *history* is the number of occurrences of this event remembered by the Thing; they
+        can be fetched with ``GET <thing>/events/<evt_id>?since=<timestamp>&limit=<n>``, where the
+        timestamp is in ISO-8601 or in milliseconds since the Unix epoch.
+    * *deadband* when given, an occurrence is dropped if its data differs from the data of the last
+        emitted occurrence by no more than *deadband* (for data that is not a number: if it is equal).
+    * *min_interval* when given, an occurrence signalled less than *min_interval* milliseconds after the
+        last emitted one is dropped.
+    * *coalesce* when True, occurrences within *min_interval* are not dropped but merged: only the latest
+        one is kept, and emitted by a background thread as soon as the interval has passed.
+
+    Dropped and merged occurrences are neither remembered nor pushed to WebSocket clients; they are
+    counted, see :meth:`change_counters`.
         '''
-        event_description = {"description": description}
-        self.event_descr[evt_id]= event_description
-        self.events[evt_id] = {"data":0, "timestamp":0}
+        change_filter = _new_filter(deadband, min_interval, coalesce)
+        occurrences = RingBuffer(history)
+        if self._restored is not None:
+            for record in self._restored["e"].pop(evt_id, ()):
+                occurrences.append((record[0], record[1]))
+        self.events[evt_id] = (description, occurrences, change_filter)
+        if change_filter is not None and coalesce:
+            self._start_sampling()
+        self._invalidate_description()
 
 
     def signal_event(self, evt_id, inp_data=None):
@@ -152,92 +359,575 @@ Thing class
     * *evt_id* is a string for choosing a registered event type.
     * *inp_data* is an optional argument for this event type.
         '''
-        if inp_data is None:
-            event = {"timestamp":self.timestamp_fn}
-            self.events[evt_id] = {"timestamp":self.timestamp_fn}
-        else:
-            event = {"data":inp_data, "timestamp":self.timestamp_fn}
+        event = self.events[evt_id]
+        record = (self.clock.isoformat(), inp_data)
+        self._event_lock.acquire()
+        try:
+            if event[_E_FILTER] is not None and not _offer(event[_E_FILTER], inp_data, record, timers.now()):
+                return
+            event[_E_HISTORY].append(record)
+            self._log_event(event, evt_id, record)
+        finally:
+            self._event_lock.release()
+        self._emit_event(evt_id, record)
+
+    def _log_event(self, event, evt_id, record):
+        # Save an occurrence added to the history; the caller holds _event_lock, so that
+        # occurrences are journaled in order.
+        if self._journal is not None:
+            self._journal.log(self.id, "e", evt_id, record, event[_E_HISTORY].size())
+
+    def _emit_event(self, evt_id, record):
+        if record[1] is not None:
             pinToggle(LED0)
-            self.events[evt_id]["data"] = inp_data
-            self.events[evt_id]["timestamp"] = self.timestamp_fn
-
-        # registering a handler for each event to respond with its information
-        webserver.register_handler(
-            "%s%s/events/%s" % (self.base_url, self.id, evt_id),
-            "get",
-            self._get_event_specific,
-            args=(evt_id)
-        )
+        self._notify("event", {evt_id: _occurrence(record)})
 
+    def change_counters(self, name):
+        '''
+..  method:: change_counters(name)
+
+    Return a tuple (dropped, coalesced) with the number of occurrences of the event *name*, or of
+    changes of the property *name*, that have been dropped or merged into a later one. Return None if
+    no deadband or minimum interval was given for it.
+        '''
+        if name in self.events:
+            change_filter = self.events[name][_E_FILTER]
+        elif name in self.properties:
+            change_filter = self.properties[name][_P_FILTER]
+        else:
+            raise KeyError
+        if change_filter is None:
+            return None
+        return (change_filter[_F_DROPPED], change_filter[_F_COALESCED])
 
-    def _dispatch_action(self, static_args, payload):
-        res = {}
 
-        if len(payload) != 1:
+    def _dispatch_action(self, static_args, payload):
+        # Queue the requested action for the action workers and return immediately.
+        if not isinstance(payload, dict) or len(payload) != 1:
             # Only one action at a time
             raise NameError
 
         for act_id in payload:
-            if act_id not in self.actions or "input" not in payload[act_id]:
+            if act_id not in self.actions or not isinstance(payload[act_id], dict) or "input" not in payload[act_id]:
                 # Action id not found
                 raise NameError
-            res[act_id] = self.callbacks[act_id](True, payload[act_id]["input"])
+
+        self._action_lock.acquire()
+        try:
+            if len(self._action_queue) >= self._action_queue_size:
+                return (503, "Service Unavailable", {"error": True, "message": "Too many pending actions"})
             act_req_id = self._get_uid()
-            act_url = '%s%s/actions/%s/%s' % (self.base_url, self.id, act_id, act_req_id)
-            self.webserver.register_handler(
-                act_url,
-                'delete',
-                self._cancel_action,
-                args=(act_req_id,)
-            )
-
-            self.webserver.register_handler(                        #registering a handler for each action request to respond with its information
-                act_url,
-                'get',
-                self._get_action_request_specific_id,
-                args=(act_req_id,)
-            )
-
-            self.running[act_req_id] = self.callbacks[act_id]
-            self.action_request_specific[act_id] = payload
-            self.action_request_specific_id[act_req_id] = payload
-
-        self.action_request.append(payload)
-        payload["status"] = "pending"
-        payload["href"] = act_url
+            payload["status"] = "pending"
+            payload["href"] = '%s%s/actions/%s/%s' % (self.base_url, self.id, act_id, act_req_id)
+            payload["timeRequested"] = self.clock.isoformat()
+            request = [act_req_id, act_id, payload, self.actions[act_id][_A_CALLBACK], None]
+            self._evict_action_requests()
+            if not self._store_action_request(request):
+                return (503, "Service Unavailable", {"error": True, "message": "Too many unfinished actions"})
+            self._log_action_request(request)
+            self._action_queue.append(request)
+            if not self._action_workers_started:
+                self._action_workers_started = True
+                for i in range(self._action_workers):
+                    thread(self._run_actions)
+        finally:
+            self._action_lock.release()
+        self._action_ready.release()
+        self._notify("actionStatus", self._action_status(request))
 
         return (201, "Created", payload)
 
+    def _run_actions(self):
+        # Action worker thread: run queued requests one at a time.
+        while True:
+            self._action_ready.acquire()
+            self._action_lock.acquire()
+            if not self._action_queue:
+                # the request has been cancelled before running
+                self._action_lock.release()
+                continue
+            request = self._action_queue.pop(0)
+            request[2]["status"] = "executing"
+            self._log_action_request(request)
+            self._action_lock.release()
+            self._notify("actionStatus", self._action_status(request))
+
+            try:
+                _call(request[3], True, request[2][request[1]]["input"])
+                status = "completed"
+            except Exception as e:
+                print("Error executing action %s" % request[1])
+                print(e)
+                status = "failed"
+
+            self._action_lock.acquire()
+            cancelled = request[4] is not None
+            if not cancelled:
+                self._finish_action_request(request, status)
+            self._action_lock.release()
+            if not cancelled:
+                self._notify("actionStatus", self._action_status(request))
+
     def _dispatch_all_event(self, static_args, payload):                     #responds with all event requests
-        return (200, "OK",[self.events])
+        # the last occurrence of every event
+        events = {}
+        self._event_lock.acquire()
+        try:
+            for evt_id in self.events:
+                history = self.events[evt_id][_E_HISTORY]
+                if history.count() == 0:
+                    events[evt_id] = {"data": 0, "timestamp": 0}
+                else:
+                    events[evt_id] = _occurrence(history.get(history.count() - 1))
+        finally:
+            self._event_lock.release()
+        return (200, "OK", [events])
+
+
+    def _cancel_action(self, static_args, payload):
+        self._action_lock.acquire()
+        try:
+            request = self._find_action_request(static_args[0], static_args[1])
+            if request is None or request[4] is not None:
+                # Only pending or executing actions can be cancelled
+                raise NameError
+            executing = request[2]["status"] == "executing"
+            if not executing:
+                # not started yet: it simply leaves the queue
+                self._action_queue.remove(request)
+            self._finish_action_request(request, "cancelled")
+        finally:
+            self._action_lock.release()
+        if executing:
+            _call(request[3], False, None)
+        self._notify("actionStatus", self._action_status(request))
+
+
+    def _finish_action_request(self, request, status):
+        request[4] = timers.now()
+        request[2]["status"] = status
+        request[2]["timeCompleted"] = self.clock.isoformat()
+        self._log_action_request(request)
+
+
+    def _log_action_request(self, request):
+        # Save the state of an action request; the caller holds _action_lock.
+        if self._journal is not None:
+            self._journal.log(self.id, "a", request[0], [request[1], request[2], request[4] is not None])
+
+
+    def _forget_action_request(self, request):
+        # Drop a request no longer remembered from the journal; the caller holds _action_lock.
+        if self._journal is not None:
+            self._journal.log(self.id, "a", request[0], None, 0)
+
+
+    def _restore_action_requests(self):
+        # Put back the action requests found in the journal, oldest first. Those that were not
+        # finished did not complete: they are restored as failed.
+        restored = self._restored["a"]
+        ids = list(restored)
+        ids.sort()
+        for act_req_id in ids:
+            act_id, payload, finished = restored[act_req_id]
+            request = [act_req_id, act_id, payload, None, None]
+            self._store_action_request(request)
+            if finished:
+                request[4] = timers.now()
+            else:
+                self._finish_action_request(request, "failed")
+            if act_req_id > self._uid:
+                self._uid = act_req_id
+        self._restored["a"] = {}
+
+
+    def _action_status(self, request):
+        payload = request[2]
+        status = {
+            "input": payload[request[1]]["input"],
+            "status": payload["status"],
+            "href": payload["href"],
+            "timeRequested": payload["timeRequested"],
+        }
+        if "timeCompleted" in payload:
+            status["timeCompleted"] = payload["timeCompleted"]
+        return {request[1]: status}
 
 
-    def _cancel_action(self, static_args):
-        act_req_id = static_args[0]
-        if act_req_id not in self.running:
-            # Only one action at a time
+    def _set_property(self, static_args, payload):
+        prop_id = static_args[0]
+        if payload is not None and not isinstance(payload, dict):
             raise NameError
-        self.running[act_req_id](False, None)
-        del self.running[act_req_id]
+        if not payload or prop_id not in payload:
+            return {
+                "error": True,
+                "message": "Missing required field: %s" % prop_id
+            }
+        error = self._check_property(prop_id, payload[prop_id])
+        if error is not None:
+            return (400, "Bad Request", {"error": True, "message": error})
+        return self._write_properties({prop_id: payload[prop_id]})
+
+    def _set_properties(self, static_args, payload):
+        # Write several properties at once. Every value is checked before any setter is
+        # called: if one is invalid nothing is written and the errors are returned.
+        if not isinstance(payload, dict) or not payload:
+            raise NameError
+        errors = {}
+        for prop_id in payload:
+            error = self._check_property(prop_id, payload[prop_id])
+            if error is not None:
+                errors[prop_id] = {"error": True, "message": error}
+        if errors:
+            return (400, "Bad Request", errors)
+        return self._write_properties(payload)
+
+    def _check_property(self, prop_id, value):
+        # Return None if value can be written to prop_id, an error message otherwise.
+        prop = self.properties.get(prop_id)
+        if prop is None:
+            return "Unknown property: %s" % prop_id
+        if prop[_P_SETTER] is None:
+            return "Read-only property: %s" % prop_id
+        prop_type = prop[_P_TYPE]
+        if prop_type == "boolean":
+            valid = isinstance(value, bool)
+        elif prop_type == "integer":
+            valid = isinstance(value, int) and not isinstance(value, bool)
+        elif prop_type == "number":
+            valid = (isinstance(value, int) or isinstance(value, float)) and not isinstance(value, bool)
+        else:
+            valid = True
+        if not valid:
+            return "Invalid value for %s property: %s" % (prop_type, prop_id)
+        return None
 
+    def _write_properties(self, values):
+        # Call the setters of already checked values and return the result of each one.
+        res = {}
+        changed = {}
+        for prop_id in values:
+            prop = self.properties[prop_id]
+            try:
+                res[prop_id] = _call(prop[_P_SETTER], values[prop_id])
+                changed[prop_id] = res[prop_id]
+                if self._journal is not None:
+                    self._journal.log(self.id, "p", prop_id, values[prop_id])
+            except Exception as e:
+                res[prop_id] = {"error": True, "message": str(e)}
+            if prop[_P_SAMPLE] is not None:
+                # the cached value is no longer valid
+                prop[_P_SAMPLE][1] = None
+        for prop_id in list(changed):
+            change_filter = self.properties[prop_id][_P_FILTER]
+            if change_filter is not None and not self._offer_change(change_filter, changed[prop_id]):
+                del changed[prop_id]
+        if changed:
+            self._notify("propertyStatus", changed)
+        return res
 
-    def _get_all_properties(self):
+    def _offer_change(self, change_filter, value):
+        self._event_lock.acquire()
+        try:
+            return _offer(change_filter, value, value, timers.now())
+        finally:
+            self._event_lock.release()
+
+
+    def _notify(self, message_type, data):
+        # Push a message of the Web Thing WebSocket protocol to every connected client, and
+        # forward events and property changes. A client that does not take the message within
+        # WEBSOCKET_WRITE_TIMEOUT is dropped, so that it delays the next ones once at most.
+        if self._forwarder is not None and message_type != "actionStatus":
+            record = {"thing": self.id, "messageType": message_type, "data": data}
+            if message_type == "propertyStatus":
+                record["timestamp"] = self.clock.isoformat()
+            self._forwarder.push(record)
+        if not self._subscribers:
+            return
+        message = json.dumps({"messageType": message_type, "data": data})
+        for ws in list(self._subscribers):
+            try:
+                ws.send(message)
+            except Exception:
+                self._unsubscribe(ws)
+
+
+    def _unsubscribe(self, ws):
+        if ws in self._subscribers:
+            self._subscribers.remove(ws)
+
+
+    def _serve_websocket(self, static_args, ws):
+        # Handle a WebSocket connected to this Thing until it is closed. Clients can set
+        # properties and request actions; updates are pushed to them by _notify().
+        self._subscribers.append(ws)
+        try:
+            while True:
+                message = ws.receive()
+                if message is None:
+                    break
+                try:
+                    message = json.loads(message)
+                    message_type = message["messageType"]
+                    data = message["data"]
+                    if message_type == "setProperty":
+                        for prop_id in data:
+                            if self._check_property(prop_id, data[prop_id]) is not None:
+                                raise NameError
+                        self._write_properties(data)
+                    elif message_type == "requestAction":
+                        self._dispatch_action((True, ), data)
+                    elif message_type != "addEventSubscription":
+                        # every event is sent to every client, subscriptions are accepted as they are
+                        raise NameError
+                except Exception:
+                    ws.send(json.dumps({
+                        "messageType": "error",
+                        "data": {"status": "400 Bad Request", "message": "Invalid message"}
+                    }))
+        finally:
+            self._unsubscribe(ws)
+
+
+    def _store_action_request(self, request):
+        # Remember a new request, making room by forgetting the oldest finished one. Return False,
+        # storing nothing, if every remembered request is still pending or executing: forgetting
+        # one of those would leave it running unseen and uncancellable.
+        history = self.action_request
+        if history.count() == history.size():
+            i = 0
+            while i < history.count() and history.get(i)[4] is None:
+                i += 1
+            if i == history.count():
+                return False
+            self._forget_action_request(history.get(i))
+            history.remove(i)
+        history.append(request)
+        return True
+
+
+    def _evict_action_requests(self):
+        if self.action_max_age is None:
+            return
+        history = self.action_request
+        now = timers.now()
+        i = 0
+        while i < history.count():
+            finished = history.get(i)[4]
+            if finished is not None and now - finished >= self.action_max_age:
+                self._forget_action_request(history.get(i))
+                history.remove(i)
+            else:
+                i += 1
+
+
+    def _find_action_request(self, act_id, act_req_id):
+        # Return the stored request act_req_id for action act_id, or None if unknown or forgotten.
+        try:
+            act_req_id = int(act_req_id)
+        except ValueError:
+            return None
+        history = self.action_request
+        for i in range(history.count()):
+            request = history.get(i)
+            if request[0] == act_req_id:
+                if request[1] == act_id:
+                    return request
+                return None
+        return None
+
+    def _get_all_properties(self, static_args=(), payload=None):
+        # the optional query parameter "ids" is a comma separated list of the properties to read
+        prop_ids = self.properties
+        if payload and "ids" in payload:
+            prop_ids = payload["ids"].split(",")
+            for prop_id in prop_ids:
+                if prop_id not in self.properties:
+                    raise NameError
         res = {}
-        for prop_id in self.properties:
-            res[prop_id] = self.getters[prop_id]()
+        for prop_id in prop_ids:
+            res[prop_id] = self._read_property(prop_id)
         return res
 
-    def _get_all_actions_requests(self):
-        return (200, "OK",self.action_request)
+    def _get_property(self, static_args, payload):
+        prop_id = static_args[0]
+        return {prop_id: self._read_property(prop_id)}
+
+    def _read_property(self, prop_id):
+        # Return the value of a property, from the cache when it is fresh enough.
+        prop = self.properties[prop_id]
+        sample = prop[_P_SAMPLE]
+        if sample is None:
+            return _call(prop[_P_GETTER])
+        now = timers.now()
+        if sample[1] is not None:
+            if sample[2] is None or now - sample[1] < sample[2]:
+                return sample[0]
+            if sample[4]:
+                sample[5] = True
+                return sample[0]
+        value = _call(prop[_P_GETTER])
+        sample[0] = value
+        sample[1] = now
+        return value
+
+    def _start_sampling(self):
+        if not self._sampling:
+            self._sampling = True
+            thread(self._sample)
+
+    def _sample(self):
+        # Background thread reading periodically sampled properties, refreshing stale ones and
+        # emitting the coalesced property changes and events whose minimum interval has passed.
+        while True:
+            wait = SAMPLER_TICK
+            for prop_id in list(self.properties):
+                prop = self.properties[prop_id]
+                sample = prop[_P_SAMPLE]
+                change_filter = prop[_P_FILTER]
+                if sample is not None:
+                    period = sample[3]
+                    now = timers.now()
+                    if sample[5] or (period is not None and (sample[1] is None or now - sample[1] >= period)):
+                        try:
+                            value = _call(prop[_P_GETTER])
+                            changed = sample[1] is None or value != sample[0]
+                            sample[0] = value
+                            sample[1] = timers.now()
+                            if change_filter is not None and changed and self._offer_change(change_filter, value):
+                                self._notify("propertyStatus", {prop_id: value})
+                        except Exception as e:
+                            print("Error while sampling property %s" % prop_id)
+                            print(e)
+                        sample[5] = False
+                    if period is not None and sample[1] is not None:
+                        wait = min(wait, max(period - (timers.now() - sample[1]), 1))
+                if change_filter is not None and change_filter[_F_PENDING] is not None:
+                    self._event_lock.acquire()
+                    pending, left = _take_pending(change_filter, timers.now())
+                    self._event_lock.release()
+                    if pending is not None:
+                        self._notify("propertyStatus", {prop_id: pending[1]})
+                    wait = min(wait, left)
+            for evt_id in list(self.events):
+                event = self.events[evt_id]
+                change_filter = event[_E_FILTER]
+                if change_filter is not None and change_filter[_F_PENDING] is not None:
+                    self._event_lock.acquire()
+                    pending, left = _take_pending(change_filter, timers.now())
+                    if pending is not None:
+                        event[_E_HISTORY].append(pending[1])
+                        self._log_event(event, evt_id, pending[1])
+                    self._event_lock.release()
+                    if pending is not None:
+                        self._emit_event(evt_id, pending[1])
+                    wait = min(wait, left)
+            sleep(wait)
+
+    def _get_action_requests(self, act_id=None):
+        self._action_lock.acquire()
+        try:
+            self._evict_action_requests()
+            res = []
+            for request in self.action_request.items():
+                if act_id is None or request[1] == act_id:
+                    res.append(request[2])
+        finally:
+            self._action_lock.release()
+        return res
 
-    def _get_action_request_specific(self,act_id):
-        return (200, "OK",self.action_request_specific[act_id])
+    def _get_all_actions_requests(self, static_args, payload):
+        return (200, "OK", self._get_action_requests())
+
+    def _get_action_request_specific(self, static_args, payload):
+        act_id = static_args[0]
+        if act_id not in self.actions:
+            return (404, "Not Found", None)
+        return (200, "OK", self._get_action_requests(act_id))
+
+    def _get_action_request_specific_id(self, static_args, payload):
+        self._action_lock.acquire()
+        try:
+            self._evict_action_requests()
+            request = self._find_action_request(static_args[0], static_args[1])
+        finally:
+            self._action_lock.release()
+        if request is None:
+            return (404, "Not Found", None)
+        return (200, "OK", request[2])
+
+    def _get_event_specific(self, static_args, payload):
+        # Return the remembered occurrences of an event, oldest first. The optional query
+        # parameters "since" (only occurrences with a later timestamp, given in ISO-8601 or in
+        # milliseconds since the Unix epoch) and "limit" (at most that many occurrences) let
+        # clients fetch only what they have not seen yet.
+        evt_id = static_args[0]
+        if evt_id not in self.events:
+            return (404, "Not Found", None)
+        since = None
+        limit = None
+        if payload:
+            if "since" in payload:
+                since = _parse_since(payload["since"])
+            if "limit" in payload:
+                try:
+                    limit = int(payload["limit"])
+                except ValueError:
+                    raise NameError
+                if limit < 0:
+                    raise NameError
+
+        self._event_lock.acquire()
+        try:
+            history = self.events[evt_id][_E_HISTORY]
+            # records are in timestamp order: walk back from the newest one
+            first = history.count()
+            while first > 0 and (since is None or _clock.parse_iso8601(history.get(first - 1)[0]) > since):
+                first -= 1
+            last = history.count()
+            if limit is not None and first + limit < last:
+                last = first + limit
+            res = []
+            for i in range(first, last):
+                res.append(_occurrence(history.get(i)))
+        finally:
+            self._event_lock.release()
+        return (200, "OK", res)
+
+
+    def _describe_properties(self):
+        res = {}
+        for prop_id in self.properties:
+            prop = self.properties[prop_id]
+            descr = {
+                "label": prop[_P_LABEL],
+                "type": prop[_P_TYPE],
+                "readOnly": prop[_P_SETTER] is None,
+                "description": prop[_P_DESCRIPTION] or "No description provided",
+                "links": [{"href": "%s%s/properties/%s" % (self.base_url, self.id, prop_id)}],
+            }
+            if prop[_P_UNIT]:
+                descr["unit"] = prop[_P_UNIT]
+            res[prop_id] = descr
+        return res
 
-    def _get_action_request_specific_id(self,act_req_id):
-        return (200, "OK",self.action_request_specific_id[act_req_id])
+    def _describe_actions(self):
+        res = {}
+        for act_id in self.actions:
+            action = self.actions[act_id]
+            res[act_id] = {
+                "label": action[_A_LABEL],
+                "description": action[_A_DESCRIPTION],
+                "input": {"type": action[_A_INPUT]},
+            }
+        return res
 
-    def _get_event_specific(self,evt_id):
-        return (200, "OK",self.events[evt_id])
+    def _describe_events(self):
+        res = {}
+        for evt_id in self.events:
+            res[evt_id] = {"description": self.events[evt_id][_E_DESCRIPTION]}
+        return res
 
 
     def as_dict(self):
@@ -249,9 +939,9 @@ Thing class
         thing = {
             "name": self.name,
             "description": self.description,
-            "properties": self.properties,
-            "actions": self.actions,
-            "events": self.event_descr,
+            "properties": self._describe_properties(),
+            "actions": self._describe_actions(),
+            "events": self._describe_events(),
             #"events": self.events,
             "links": [
                 {
@@ -275,6 +965,178 @@ Thing class
         return thing
 
 
+class RingBuffer():
+    '''
+====
+RingBuffer class
+====
+
+.. class:: RingBuffer(size)
+
+    A fixed-capacity buffer of items kept in insertion order. Memory for *size* items is
+    allocated once; appending to a full buffer overwrites the oldest item.
+    '''
+
+    def __init__(self, size):
+        self._items = [None] * size
+        self._head = 0
+        self._count = 0
+
+    def size(self):
+        '''
+.. method:: size()
+
+    Return the capacity of the buffer.
+        '''
+        return len(self._items)
+
+    def count(self):
+        '''
+.. method:: count()
+
+    Return the number of items currently stored.
+        '''
+        return self._count
+
+    def append(self, item):
+        '''
+.. method:: append(item)
+
+    Add *item* as the newest item and return the item it replaced, or None if the buffer was not full.
+        '''
+        size = len(self._items)
+        if self._count == size:
+            evicted = self._items[self._head]
+            self._items[self._head] = item
+            self._head = (self._head + 1) % size
+            return evicted
+        self._items[(self._head + self._count) % size] = item
+        self._count += 1
+        return None
+
+    def get(self, i):
+        '''
+.. method:: get(i)
+
+    Return the *i*-th item, starting from the oldest one.
+        '''
+        if i < 0 or i >= self._count:
+            raise IndexError
+        return self._items[(self._head + i) % len(self._items)]
+
+    def remove(self, i):
+        '''
+.. method:: remove(i)
+
+    Remove the *i*-th item, starting from the oldest one; newer items are moved back by one place.
+        '''
+        if i < 0 or i >= self._count:
+            raise IndexError
+        size = len(self._items)
+        while i < self._count - 1:
+            self._items[(self._head + i) % size] = self._items[(self._head + i + 1) % size]
+            i += 1
+        self._items[(self._head + i) % size] = None
+        self._count -= 1
+
+    def items(self):
+        '''
+.. method:: items()
+
+    Return a list of the stored items, from the oldest to the newest.
+        '''
+        size = len(self._items)
+        return [self._items[(self._head + i) % size] for i in range(self._count)]
+
+
+def _new_filter(deadband, min_interval, coalesce):
+    if deadband is None and min_interval is None:
+        return None
+    return [deadband, min_interval, coalesce, None, None, None, 0, 0]
+
+
+def _offer(change_filter, value, item, now):
+    # Return True if value has to be emitted now, False if it has been dropped, or kept pending
+    # for being emitted later as item. The caller holds the lock protecting change_filter.
+    f = change_filter
+    if f[_F_LAST_TIME] is not None:
+        deadband = f[_F_DEADBAND]
+        if deadband is not None and _within(value, f[_F_LAST], deadband):
+            f[_F_DROPPED] += 1
+            if f[_F_PENDING] is not None:
+                # back within the deadband before the pending value was emitted
+                f[_F_PENDING] = None
+                f[_F_COALESCED] += 1
+            return False
+        interval = f[_F_MIN_INTERVAL]
+        if interval is not None and now - f[_F_LAST_TIME] < interval:
+            if not f[_F_COALESCE]:
+                f[_F_DROPPED] += 1
+            else:
+                if f[_F_PENDING] is not None:
+                    f[_F_COALESCED] += 1
+                f[_F_PENDING] = (value, item)
+            return False
+    if f[_F_PENDING] is not None:
+        f[_F_PENDING] = None
+        f[_F_COALESCED] += 1
+    f[_F_LAST] = value
+    f[_F_LAST_TIME] = now
+    return True
+
+
+def _take_pending(change_filter, now):
+    # Return a tuple (pending (value, item) to emit now or None, milliseconds before the next check).
+    f = change_filter
+    if f[_F_PENDING] is None:
+        return (None, SAMPLER_TICK)
+    left = f[_F_LAST_TIME] + f[_F_MIN_INTERVAL] - now
+    if left > 0:
+        return (None, left)
+    pending = f[_F_PENDING]
+    f[_F_PENDING] = None
+    f[_F_LAST] = pending[0]
+    f[_F_LAST_TIME] = now
+    return (pending, SAMPLER_TICK)
+
+
+def _within(value, last, deadband):
+    if _is_number(value) and _is_number(last):
+        return abs(value - last) <= deadband
+    return value == last
+
+
+def _is_number(value):
+    return (isinstance(value, int) or isinstance(value, float)) and not isinstance(value, bool)
+
+
+def _call(fun, *args):
+    # Call a getter, setter or action callback.
+    res = fun(*args)
+    if _resolve is not None:
+        res = _resolve(res)
+    return res
+
+
+def _parse_since(text):
+    # Milliseconds since the Unix epoch of the "since" query parameter. A "+" of the time zone
+    # arrives as a space when the client did not escape it.
+    text = text.strip().replace(" ", "+")
+    try:
+        if text.isdigit():
+            return int(text)
+        return _clock.parse_iso8601(text)
+    except Exception:
+        raise NameError
+
+
+def _occurrence(record):
+    # Web Thing representation of a (timestamp, data) event record.
+    if record[1] is None:
+        return {"timestamp": record[0]}
+    return {"data": record[1], "timestamp": record[0]}
+
+
 def encapsulate(args, *fun_args):
     # Utility function for encapsulating a function result inside a dict.
 
@@ -320,94 +1182,123 @@ def decapsulate(args, payload):
     }
 
 
-def list_things(static_args):
+def list_things(static_args, payload=None):
+    global _things_description
     things = static_args[0]
-    return [thing.as_dict() for thing in things]
+    if _things_description is None or _things_description[0] != _descriptions_generation:
+        _things_description = (_descriptions_generation,
+                               webserver.serialize([thing.as_dict() for thing in things]))
+    return _things_description[1]
 
 
-def run_server(things):
-    ip = _get_self_ip()
-    if not ip:
-        print("Please connect to Wi-Fi first.")
-        raise RuntimeError
+def describe_thing(static_args, payload=None):
+    thing = static_args[0]
+    if thing._description is None:
+        thing._description = webserver.serialize(thing.as_dict())
+    return thing._description
 
-    print("Device IP address is: %s" % ip)
 
-    thread(webserver.start)
+def run_server(things, workers=None, queue_size=4, lazy=False, engine=None):
+    '''
+.. function:: run_server(things, workers=None, queue_size=4, lazy=False, engine=None)
+
+    Start the webserver and expose *things* through it.
+
+    * *things* is a Thing or a list of Things.
+    * *workers* is the number of threads serving connections concurrently, by default the
+        ``DEFAULT_WORKERS`` of the engine, so that clients keep their connections open between
+        requests. With 0 connections are served one at a time, and closed once the requests they
+        carry have been answered, so that no client waits behind an idle one: this saves the
+        threads but costs a new connection per request.
+    * *queue_size* is the number of accepted connections that may wait for a free worker.
+    * *lazy* when True the webserver only knows the path prefix of every Thing, and each Thing
+        resolves the rest of the path from its own properties, actions and events when a request
+        arrives. Startup time and memory then no longer grow with the number of properties, which
+        suits gateways exposing many Things.
+    * *engine* is the module serving the requests: :mod:`webserver` by default, or :mod:`aioserver` on
+        CPython, which serves many keep-alive connections with asyncio and lets getters, setters and
+        action callbacks be coroutine functions. *workers* and *queue_size* are passed to its ``start()``.
+        Only :mod:`webserver` needs the Wi-Fi link.
+    '''
+    global _resolve
+    if engine is None:
+        engine = webserver
+    if workers is None:
+        workers = engine.DEFAULT_WORKERS
+    if engine is webserver:
+        ip = _get_self_ip()
+        if not ip:
+            print("Please connect to Wi-Fi first.")
+            raise RuntimeError
+        print("Device IP address is: %s" % ip)
+    else:
+        # a host engine: the host is already on the network
+        _resolve = engine.resolve
+
+    thread(engine.start, workers, queue_size)
+    if engine is not webserver:
+        # the port is only known once listening when PORT leaves it to the system
+        port = engine.wait_listening()
+        if port is None:
+            print("The webserver could not start.")
+            raise RuntimeError
+        ip = "%s:%s" % (engine.HOST, port)
 
     if isinstance(things, Thing):
         # If the parameter is a single thing we make a list with it
         things = [things]
 
-    webserver.register_handler("/", "get", list_things, args=(things, ))
+    # collect every route first, so that the webserver publishes its route table once
+    handlers = [("/", "get", list_things, (things, ))]
+    dispatchers = []
     for thing in things:
-        thing._set_webserver(webserver) # Thing need a webserver to dinamically add actions endpoints
-        webserver.register_handler("/%s" % thing.id, "get", thing.as_dict)
-        # Properties
-        webserver.register_handler(
-            "%s%s/properties" % (thing.base_url, thing.id),
-            "get",
-            thing._get_all_properties
-        )
-
-        for prop_id in thing.properties:
-            prop = thing.properties[prop_id]
-
-            # Register property getter
-            webserver.register_handler(
-                "%s%s/properties/%s" % (thing.base_url, thing.id, prop_id),
-                "get",
-                encapsulate,
-                args=(prop_id, thing.getters[prop_id])
-            )
-            if not prop["readOnly"]:
-                # Register property setter
-                webserver.register_handler(
-                    "%s%s/properties/%s" % (thing.base_url, thing.id, prop_id),
-                    "put",
-                    decapsulate,
-                    args=(prop_id, thing.setters[prop_id])
-                )
-
-
-        # Actions dispatcher
-        webserver.register_handler(
-            "%s%s/actions" % (thing.base_url, thing.id),
-            "post",
-            thing._dispatch_action,
-            args=(True, )
-        )
-        webserver.register_handler(
-            "%s%s/actions" % (thing.base_url, thing.id),
-            "cancel",
-            thing._dispatch_action,
-            args=(False, )
-        )
+        thing._set_webserver(engine) # Thing need a webserver to dinamically add actions endpoints
+        if lazy:
+            dispatchers.append(("%s%s" % (thing.base_url, thing.id), thing._dispatch, ()))
+            if thing.base_url != "/":
+                handlers.append(("/%s" % thing.id, "get", describe_thing, (thing, )))
+                handlers.append(("/%s" % thing.id, "websocket", thing._serve_websocket, ()))
+        else:
+            _add_routes(handlers, thing)
+    engine.register_dispatchers(dispatchers)
+    engine.register_handlers(handlers)
+    for thing in things:
+        print("Device ready at: http://%s/%s" % (ip, thing.id))
 
-        # events dispatcher
-        webserver.register_handler(
-            "%s%s/events" % (thing.base_url, thing.id),
-            "get",
-            thing._dispatch_all_event,
-            args=(False, )
-        )
-        #
-        webserver.register_handler(
-            "%s%s/actions" % (thing.base_url, thing.id),
-            "get",
-            thing._get_all_actions_requests,
-            args=(False, )
-        )
 
-        for act_id in thing.actions:
-            # Register action getter
-            webserver.register_handler(
-                "%s%s/actions/%s" % (thing.base_url, thing.id, act_id),
-                "get",
-                thing._get_action_request_specific,
-                args=(act_id,)
-            )
-        print("Device ready at: http://%s/%s" % (ip, thing.id))
+def _add_routes(handlers, thing):
+    # Append every route of thing to handlers as (path, method, func, args) tuples for
+    # webserver.register_handlers(), see Thing._dispatch() for the lazy equivalent.
+    prefix = "%s%s" % (thing.base_url, thing.id)
+    handlers.append(("/%s" % thing.id, "get", describe_thing, (thing, )))
+    handlers.append(("/%s" % thing.id, "websocket", thing._serve_websocket, ()))
+    # Properties
+    handlers.append((prefix + "/properties", "get", thing._get_all_properties, ()))
+    handlers.append((prefix + "/properties", "put", thing._set_properties, ()))
+
+    for prop_id in thing.properties:
+        prop = thing.properties[prop_id]
+        # Register property getter
+        handlers.append(("%s/properties/%s" % (prefix, prop_id), "get", thing._get_property, (prop_id, )))
+        if prop[_P_SETTER] is not None:
+            # Register property setter
+            handlers.append(("%s/properties/%s" % (prefix, prop_id), "put", thing._set_property, (prop_id, )))
+
+    # Actions dispatcher
+    handlers.append((prefix + "/actions", "post", thing._dispatch_action, (True, )))
+    handlers.append((prefix + "/actions", "cancel", thing._dispatch_action, (False, )))
+
+    # events dispatcher
+    handlers.append((prefix + "/events", "get", thing._dispatch_all_event, (False, )))
+    #
+    handlers.append((prefix + "/actions", "get", thing._get_all_actions_requests, (False, )))
+
+    # Action requests and events are served by parameterised routes, so that
+    # the route table does not grow with the number of requests or events
+    handlers.append((prefix + "/actions/{action}", "get", thing._get_action_request_specific, ()))
+    handlers.append((prefix + "/actions/{action}/{request_id}", "get", thing._get_action_request_specific_id, ()))
+    handlers.append((prefix + "/actions/{action}/{request_id}", "delete", thing._cancel_action, ()))
+    handlers.append((prefix + "/events/{event}", "get", thing._get_event_specific, ()))
 
 
 def _get_self_ip():